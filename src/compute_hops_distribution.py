@@ -1,65 +1,58 @@
 # Function to Compute Hop Distribution in Parallel with Error Handling
 import os
 import time
-import gzip
-import pickle
 import json
+import shutil
+import tempfile
 import networkx as nx
+import numpy as np
 import pandas as pd
+import polars as pl
 import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from tqdm import tqdm
 
+from transfer_graph import TransferGraph, convert_gpickle, multi_source_bfs
+
 DATA_DIR = os.path.realpath(os.path.join(os.getcwd(), "..", "data"))
 GRAPH_DIR = os.path.join(DATA_DIR, "graphs")
+# Graphs are memory-mapped by every worker from GRAPH_DIR; the node ids of each run are shared
+# through .npy files in shared memory when available
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+# Graphs with at least this many edges have their exchange set split across the workers
+PARTITION_MIN_EDGES = 10_000_000
 percentiles = [.01, .05, .1, .2, .25, .50, .75, .8, .9, .95, .99]
 
 
 # Function to compute hop distribution for a single node
-def compute_hop_for_node(graph, source_set, target_set):
-    paths = nx.multi_source_dijkstra_path_length(
-        G=graph, sources=source_set)
-    hop_distances = [hops for target,
-                     hops in paths.items() if target in target_set]
-
-    return hop_distances
+def compute_hop_for_node(graph, source_set, target_set, max_hops=None):
+    # Multi-source BFS from the exchanges over the reversed edges (Address -> Exchange read backwards),
+    # stopping as soon as every target is labelled
+    sources = graph.get_node_ids(list(source_set))
+    targets = graph.get_node_ids(list(target_set))
+    targets = targets[targets >= 0]
+    distances = graph.multi_source_bfs(
+        sources, reverse=True, max_hops=max_hops, targets=targets)
+    hop_distances = distances[targets]
+    return hop_distances[hop_distances >= 0].tolist()
 
 
 # Parallel function to compute hop distribution with error handling
-def compute_hop_distribution_parallel(graph, exchange_addresses, claim_receivers):
+def compute_hop_distribution_parallel(graph, exchange_addresses, claim_receivers, max_hops=None):
+    if isinstance(graph, nx.Graph):
+        graph = TransferGraph.from_networkx(graph)
     # Source will be the exchanges
-    source_set = frozenset(
-        address for address in exchange_addresses if graph.has_node(address))
+    source_set = frozenset(exchange_addresses)
     # Target will be the accounts
-    target_set = frozenset(
-        address for address in claim_receivers if graph.has_node(address))
-
-    # Reversing graph to check convert from Address -> Exchange to Exchange -> Address
-    graph_reversed = graph.reverse()
+    target_set = frozenset(claim_receivers)
 
     hop_counts = compute_hop_for_node(
-        graph=graph_reversed, source_set=source_set, target_set=target_set)
+        graph=graph, source_set=source_set, target_set=target_set, max_hops=max_hops)
 
     hop_counts = [hop for hop in hop_counts if hop > 0]
     return pd.Series(hop_counts)
 
 
-# Main function to demonstrate usage
-def load_graph_from_gzip(protocol):
-    file_path = os.path.join(
-        GRAPH_DIR, "full_graph_{}.gpickle".format(protocol))
-    try:
-        with gzip.open(file_path, 'rb') as f:
-            graph = pickle.load(f)
-        print(f"Graph successfully loaded from {file_path}")
-        print("The graph contains {} nodes and {} edges.".format(
-            graph.number_of_nodes(), graph.number_of_edges()))
-        return graph
-    except Exception as e:
-        print(f"Error loading graph from {file_path}: {e}")
-        traceback.print_exc()
-        return None
-
-
 def load_addresses():
     addresses = {"exchange_addresses": set(), "claim_receivers": {}}
 
@@ -76,13 +69,6 @@ def load_addresses():
     return addresses
 
 
-def check_for_hops(graph, exchange_addresses, claim_receivers):
-    # Compute hop distribution for airdrop addresses
-    hop_distribution = compute_hop_distribution_parallel(
-        graph, exchange_addresses, claim_receivers)
-    return hop_distribution
-
-
 def persist_hop_distribution(data, protocol):
     file_path = os.path.join(
         DATA_DIR, "hop_distribution_{}.json".format(protocol))
@@ -90,25 +76,187 @@ def persist_hop_distribution(data, protocol):
         json.dump(data, f)
 
 
-def process_protocols(protocols):
-    # Define target addresses and claim receivers
+def get_graph_dir(protocol):
+    return os.path.join(GRAPH_DIR, "graph_{}".format(protocol))
+
+
+def is_converted(protocol):
+    # Whether the memory-mapped graph exists and is not older than full_graph_<protocol>.gpickle
+    graph_dir = get_graph_dir(protocol)
+    file_path = os.path.join(
+        GRAPH_DIR, "full_graph_{}.gpickle".format(protocol))
+    return TransferGraph.is_saved(graph_dir) and (not os.path.exists(file_path) or os.path.getmtime(file_path) <=
+                                                  os.path.getmtime(os.path.join(graph_dir, 'graph.json')))
+
+
+def load_graph(protocol, mmap=True):
+    # Open the memory-mapped graph, converting full_graph_<protocol>.gpickle on first use (or when the
+    # gpickle was rewritten since the conversion)
+    if is_converted(protocol):
+        graph = TransferGraph.load(get_graph_dir(protocol), mmap=mmap)
+    else:
+        graph = convert_gpickle(os.path.join(GRAPH_DIR, "full_graph_{}.gpickle".format(protocol)),
+                                get_graph_dir(protocol))
+    print("The graph contains {} nodes and {} edges.".format(
+        graph.number_of_nodes(), graph.number_of_edges()))
+    return graph
+
+
+def convert_graphs(protocols):
+    # Convert the gpickle graphs that are not converted yet to the memory-mapped format, one at a time:
+    # each conversion materialises the whole networkx graph
+    # Returns the protocols whose graph could not be converted
+    failed = list()
+    for protocol in tqdm([protocol for protocol in protocols if not is_converted(protocol)], "Converting graphs"):
+        try:
+            convert_gpickle(os.path.join(GRAPH_DIR, "full_graph_{}.gpickle".format(protocol)),
+                            get_graph_dir(protocol))
+        except Exception as e:
+            print(f"Error converting {protocol}: {e}")
+            traceback.print_exc()
+            failed.append(protocol)
+    return failed
+
+
+def get_graph_size(protocol):
+    # Number of edges of the converted graph, used to schedule the largest protocols first
+    graph_dir = get_graph_dir(protocol)
+    if not TransferGraph.is_saved(graph_dir):
+        return 0
+    with open(os.path.join(graph_dir, 'graph.json')) as f:
+        return json.load(f)['n_edges']
+
+
+def share_graph(protocol, exchange_addresses, claim_receivers, shared_dir):
+    # Worker: open the memory-mapped graph (converted by the parent) and write the node ids of the
+    # exchanges (sources) and of the claim receivers (targets); the BFS workers map the graph arrays
+    graph = load_graph(protocol=protocol)
+    sources = graph.get_node_ids(list(exchange_addresses))
+    targets = np.unique(graph.get_node_ids(list(claim_receivers)))
+    path = os.path.join(shared_dir, protocol)
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'sources.npy'), sources[sources >= 0])
+    np.save(os.path.join(path, 'targets.npy'), targets[targets >= 0])
+    return get_graph_dir(protocol), path, graph.number_of_edges()
+
+
+def compute_shared_hops(graph_dir, path, partition, n_partitions, max_hops=None):
+    # Worker: hop distances of the targets from one partition of the exchanges over the reverse adjacency
+    offsets = np.load(os.path.join(graph_dir, 'in_offsets.npy'), mmap_mode='r')
+    neighbors = np.load(os.path.join(
+        graph_dir, 'in_neighbors.npy'), mmap_mode='r')
+    sources = np.array_split(
+        np.load(os.path.join(path, 'sources.npy')), n_partitions)[partition]
+    targets = np.load(os.path.join(path, 'targets.npy'))
+    distances = multi_source_bfs(offsets, neighbors, sources,
+                                 max_hops=max_hops, targets=targets)
+    return distances[targets]
+
+
+def merge_hops(partitions):
+    # Distance from the nearest exchange: minimum over the partitions of the exchange set
+    distances = np.vstack(partitions).astype(np.int64)
+    distances[distances < 0] = np.iinfo(np.int64).max
+    distances = distances.min(axis=0)
+    return distances[(distances > 0) & (distances < np.iinfo(np.int64).max)]
+
+
+def process_protocols(protocols, max_workers=None, max_hops=None):
+    # Protocols run on a process pool, the largest first to minimise the makespan: a worker opens each
+    # memory-mapped graph and writes the node ids, then the BFS runs as one task per protocol or, for the
+    # largest graphs, one task per partition of the exchange set
+    # The gpickles are converted beforehand in this process, one at a time, so that the workers never
+    # hold several networkx graphs in memory at once
     addresses = load_addresses()
     exchange_addresses = addresses["exchange_addresses"]
     claim_receivers = addresses["claim_receivers"]
 
+    max_workers = max_workers or os.cpu_count()
+    failed = convert_graphs(protocols)
+    protocols = sorted([protocol for protocol in protocols if protocol not in failed],
+                       key=get_graph_size, reverse=True)
+    start_times = dict()
+    partitions = dict()
+    shared_dir = tempfile.mkdtemp(prefix='hops_', dir=SHARED_DIR)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor, \
+                tqdm(total=len(protocols), desc="Processing protocols") as progress:
+            pending = dict()
+            for protocol in protocols:
+                start_times[protocol] = time.time()
+                future = executor.submit(share_graph, protocol, exchange_addresses,
+                                         claim_receivers[protocol], shared_dir)
+                pending[future] = (protocol, None)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    protocol, partition = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f"Error processing {protocol}: {e}")
+                        traceback.print_exc()
+                        # The protocol is counted once, at its first failure
+                        if partition is None or protocol in partitions:
+                            progress.update(1)
+                        partitions.pop(protocol, None)
+                        continue
+                    if protocol not in partitions and partition is not None:
+                        # Another partition of the protocol failed
+                        continue
+                    if partition is None:
+                        graph_dir, path, n_edges = result
+                        n_partitions = max_workers if n_edges >= PARTITION_MIN_EDGES else 1
+                        partitions[protocol] = [None] * n_partitions
+                        for index in range(n_partitions):
+                            future = executor.submit(
+                                compute_shared_hops, graph_dir, path, index, n_partitions, max_hops)
+                            pending[future] = (protocol, index)
+                        continue
+                    partitions[protocol][partition] = result
+                    if all(hops is not None for hops in partitions[protocol]):
+                        hop_distribution = merge_hops(partitions.pop(protocol))
+                        persist_hop_distribution(
+                            hop_distribution.tolist(), protocol)
+                        shutil.rmtree(os.path.join(
+                            shared_dir, protocol), ignore_errors=True)
+                        elapsed_time = time.time() - start_times[protocol]
+                        print(
+                            f"Execution time for {protocol}: {elapsed_time:.4f} seconds")
+                        progress.update(1)
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+
+def load_claims(protocol):
+    # First claim block of every claim receiver ('account', or 'to' for the claims taken from the transfers)
+    claims = pl.scan_parquet(os.path.join(
+        DATA_DIR, "{}_claim.parquet".format(protocol)))
+    receiver = 'account' if 'account' in claims.collect_schema() else 'to'
+    return (claims
+            .group_by(pl.col(receiver).alias('receiver'))
+            .agg(pl.col('blockNumber').min())
+            .collect())
+
+
+def compute_temporal_hop_distribution(graph, exchange_addresses, claims):
+    # Minimum hops and earliest arrival at an exchange of every claim receiver over the transfers made
+    # after its claim, in chronological order (unlike compute_hop_distribution_parallel)
+    if isinstance(graph, nx.Graph):
+        graph = TransferGraph.from_networkx(graph)
+    return graph.temporal_hops(claims['receiver'], claims['blockNumber'], exchange_addresses)
+
+
+def process_temporal_protocols(protocols):
+    exchange_addresses = load_addresses()["exchange_addresses"]
     for protocol in tqdm(protocols, "Processing protocols"):
         start_time = time.time()
         print(">>>>", protocol.upper())
-        # Load graph from file
-        graph = load_graph_from_gzip(protocol=protocol)
-
-        # Compute hop distribution in parallel
-        hop_distribution = check_for_hops(
-            graph, exchange_addresses, claim_receivers[protocol])
-
-        persist_hop_distribution(hop_distribution.to_list(), protocol)
-        end_time = time.time()
-        elapsed_time = end_time - start_time
+        hops = compute_temporal_hop_distribution(
+            load_graph(protocol=protocol), exchange_addresses, load_claims(protocol))
+        hops.write_parquet(os.path.join(
+            DATA_DIR, "temporal_hops_{}.parquet".format(protocol)))
+        elapsed_time = time.time() - start_time
         print(f"Execution time for {protocol}: {elapsed_time:.4f} seconds")
 
 
@@ -5,81 +5,193 @@
 # https://github.com/johnnatan-messias/ethereum-crawler/blob/main/1-dataset.ipynb
 # https://github.com/johnnatan-messias/chainlink-data-feed-crawler
 
+import gzip
+import hashlib
 import itertools
 import json
 import os
+import pickle
+import threading
 import time
 import traceback
+from collections import Counter
 from concurrent.futures import ThreadPoolExecutor
 
+import polars as pl
 import requests
+from eth_abi.exceptions import DecodingError
+from eth_utils import event_abi_to_log_topic
 from tqdm.notebook import tqdm
 from web3 import Web3
+from web3._utils.events import get_event_data
+from web3._utils.method_formatters import get_result_formatters
+from web3._utils.rpc_abi import RPC
+from web3.datastructures import AttributeDict
+from web3.exceptions import LogTopicError, MismatchedABI
 
 
-def get_abi_from_etherscan(contract_address, etherscan_api_key=os.environ["ETHERSCAN_API_KEY"], n_err=5):
+# Storage slots holding the implementation address of upgradeable proxies
+# EIP-1967, EIP-1822 (UUPS) and the legacy OpenZeppelin (zos) proxies
+PROXY_IMPLEMENTATION_SLOTS = ['0x360894a13ba1a3210667c828492db98dca3e2076cc3735a920a3ca505d382bbc',
+                              '0xc5f16f0fcc639fa48a6947836d9850f504798523bf8c9a3a87d5876cf622bcf7',
+                              '0x7050c9e0f4ca769c69bd3a8ef740bc37934f8e2c036e5a723fd8ee048ed3f8c3']
+
+
+def get_abi_from_etherscan(contract_address, etherscan_api_key=None, n_err=5):
     # Get contract ABI from Etherscan
+    if etherscan_api_key is None:
+        etherscan_api_key = os.environ["ETHERSCAN_API_KEY"]
     api_url_format = 'https://api.etherscan.io/api?module=contract&action=getabi&address={address}&apikey={apikey}'
     api_url = api_url_format.format(
         address=contract_address, apikey=etherscan_api_key)
-    abi = dict()
-    while n_err > 0:
+    for attempt in range(n_err):
         try:
-            rq = requests.get(api_url)
-            if rq.status_code == 200:
-                response = rq.json()['result']
-                abi = json.loads(response)
-                rq.connection.close()
-                break
-        except TimeoutError:
-            n_err -= 1
-            time.sleep(.5)
-        finally:
-            rq.connection.close()
+            with requests.get(api_url, timeout=30) as rq:
+                if rq.status_code == 200:
+                    response = rq.json()
+                    if response['status'] == '1':
+                        return json.loads(response['result'])
+                    if 'not verified' in response['result']:
+                        raise ValueError('Error: {} ({})'.format(
+                            response['result'], contract_address))
+                    # Rate limited or temporary error
+        except (requests.exceptions.RequestException, TimeoutError):
+            pass
+        time.sleep(.5 * 2 ** attempt)
+    raise (TimeoutError('Error: Cannot get ABI'))
+
+
+class ABICache:
+    # On-disk content-addressed ABI cache
+    # <cache_dir>/abis/<sha256>.json stores every distinct ABI once and <cache_dir>/index.json maps
+    # contract addresses to the hash of their ABI and to their proxy implementation (if any)
+    # In offline mode a missing ABI raises instead of reaching Etherscan
+
+    def __init__(self, cache_dir, offline=False):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        os.makedirs(os.path.join(cache_dir, 'abis'), exist_ok=True)
+        self.index = dict()
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def get_abi_path(self, abi_hash):
+        return os.path.join(self.cache_dir, 'abis', abi_hash + '.json')
+
+    def save_index(self):
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f, indent=4, sort_keys=True)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def get_entry(self, contract_address):
+        return self.index.setdefault(contract_address.lower(), dict())
+
+    def get_abi(self, contract_address):
+        abi_hash = self.index.get(contract_address.lower(), dict()).get('abi')
+        if abi_hash is None:
+            return None
+        with open(self.get_abi_path(abi_hash)) as f:
+            return json.load(f)
+
+    def put_abi(self, contract_address, abi):
+        content = json.dumps(abi, sort_keys=True, separators=(',', ':'))
+        abi_hash = hashlib.sha256(content.encode()).hexdigest()
+        if not os.path.exists(self.get_abi_path(abi_hash)):
+            with open(self.get_abi_path(abi_hash) + '.tmp', 'w') as f:
+                f.write(content)
+            os.replace(self.get_abi_path(abi_hash) + '.tmp',
+                       self.get_abi_path(abi_hash))
+        self.get_entry(contract_address)['abi'] = abi_hash
+        self.save_index()
+
+    def has_implementation(self, contract_address):
+        return 'implementation' in self.index.get(contract_address.lower(), dict())
+
+    def get_implementation(self, contract_address):
+        return self.index.get(contract_address.lower(), dict()).get('implementation')
+
+    def put_implementation(self, contract_address, implementation_address):
+        # None records that the contract is not a proxy
+        self.get_entry(contract_address)['implementation'] = implementation_address
+        self.save_index()
 
-    if n_err == 0:
-        raise (TimeoutError('Error: Cannot get ABI'))
+
+def get_abi(contract_address, abi_cache=None):
+    # Get contract ABI from the cache, falling back to Etherscan
+    if abi_cache is None:
+        return get_abi_from_etherscan(contract_address)
+    abi = abi_cache.get_abi(contract_address)
+    if abi is None:
+        if abi_cache.offline:
+            raise KeyError(
+                'Error: ABI of {} is not cached'.format(contract_address))
+        abi = get_abi_from_etherscan(contract_address)
+        abi_cache.put_abi(contract_address, abi)
     return abi
 
 
-def get_contract(w3, contract_address, abi_contract_address=None):
-    # Get contract ABI from Etherscan
+def get_proxy_implementation(w3, contract_address, abi_cache=None):
+    # Get the implementation address of an upgradeable proxy or None if the contract is not a proxy
+    if abi_cache is not None and (abi_cache.offline or abi_cache.has_implementation(contract_address)):
+        return abi_cache.get_implementation(contract_address)
+    implementation_address = None
+    for slot in PROXY_IMPLEMENTATION_SLOTS:
+        value = w3.eth.get_storage_at(
+            to_checksum_address(contract_address), slot)
+        if int.from_bytes(value, 'big') != 0:
+            implementation_address = to_checksum_address(
+                '0x' + bytes(value[-20:]).hex())
+            break
+    if abi_cache is not None:
+        abi_cache.put_implementation(contract_address, implementation_address)
+    return implementation_address
+
+
+def get_contract(w3, contract_address, abi_contract_address=None, abi_cache=None, resolve_proxy=False):
+    # Get contract ABI from Etherscan (or from abi_cache when given)
+    # With resolve_proxy the ABI of the proxy implementation is used when abi_contract_address is not set
+    if abi_contract_address is None and resolve_proxy:
+        abi_contract_address = get_proxy_implementation(
+            w3, contract_address, abi_cache=abi_cache)
     if abi_contract_address is None:
         abi_contract_address = contract_address
-    abi = get_abi_from_etherscan(abi_contract_address)
+    abi = get_abi(abi_contract_address, abi_cache=abi_cache)
     # Create contract object
     contract = w3.eth.contract(address=contract_address, abi=abi)
     return contract
 
 
+def get_logs_with_retry(fetch_logs, start_block, end_block, n_err=15):
+    # Call fetch_logs(start_block, end_block) retrying transient errors up to n_err times
+    # Rate-limit errors back off exponentially, other errors are retried after .5s
+    for attempt in range(n_err):
+        try:
+            return fetch_logs(start_block, end_block)
+        except Exception as e:
+            if attempt == n_err - 1:
+                raise TimeoutError('Error: Cannot get logs in [{}, {}]!'.format(start_block, end_block)) from e
+            time.sleep(min(.5 * 2 ** attempt, 30) if is_rate_limit_error(e) else .5)
+
+
 def get_events_from_contract(params):
     # Get all event data from a contract
     contract_event_function = params['contract_event_function']
-    start_block = params['start_block']
-    end_block = params['end_block']
-
-    filtered_event = list()
-    n_err = 15
-    while n_err > 0:
-        # filtered_events_function = contract_event_function.get_logs(
-        #     from_block=start_block, to_lock=end_block)
-        try:
-            filtered_event = contract_event_function.get_logs(
-                from_block=start_block, to_block=end_block)
-            break
-        except TimeoutError:
-            n_err -= 1
-            time.sleep(.5)
-    if n_err == 0:
-        raise (TimeoutError('Error: Cannot get events from contract!'))
-    return filtered_event
 
+    def fetch_logs(from_block, to_block):
+        return contract_event_function.get_logs(from_block=from_block, to_block=to_block)
 
-def get_batch_intervals(block_start, block_end, batch_size):
+    return get_logs_with_retry(fetch_logs, params['start_block'], params['end_block'])
+
+
+def get_batch_intervals(block_start, block_end, batch_size, inclusive=False):
     # Improved version of the line code below
     # pd.interval_range(start=block_number_min, end=block_number_max, freq=batch_size)
+    # With inclusive=True the last interval always ends at block_end
     intervals = list()
-    block_numbers = list(range(block_start, block_end, batch_size))
+    block_numbers = list(
+        range(block_start, block_end + 1 if inclusive else block_end, batch_size))
     for block_number in block_numbers:
         block_interval_start = block_number
         block_interval_end = min(block_number + batch_size - 1, block_end)
@@ -87,9 +199,349 @@ def get_batch_intervals(block_start, block_end, batch_size):
     return intervals
 
 
-def get_events(contract_event_function, start_block, end_block, batch_size=5000, max_workers=20):
+# Substrings of the errors providers return when an eth_getLogs window is too
+# dense (too many results, response too large or query timeout)
+RANGE_ERROR_MESSAGES = ('more than', 'too many results', 'too many logs', 'response size',
+                        'response is too big', 'block range', 'range is too', 'is limited to',
+                        'timeout', 'timed out', '-32005')
+
+# Substrings of the errors providers return when the client is rate limited (HTTP 429)
+RATE_LIMIT_ERROR_MESSAGES = ('429 client error', 'rate limit', 'request rate', 'too many requests',
+                             'requests per second', 'compute units')
+
+
+def is_rate_limit_error(error):
+    # Check whether an error is caused by the provider rate limit (to back off, not to split)
+    response = getattr(error, 'response', None)
+    if getattr(response, 'status_code', None) == 429:
+        return True
+    message = str(error).lower()
+    return any(error_message in message for error_message in RATE_LIMIT_ERROR_MESSAGES)
+
+
+def is_range_error(error):
+    # Check whether an eth_getLogs error is caused by the size of the window
+    if isinstance(error, TimeoutError):
+        return True
+    if is_rate_limit_error(error):
+        return False
+    message = str(error).lower()
+    return any(error_message in message for error_message in RANGE_ERROR_MESSAGES)
+
+
+class BlockRangePlanner:
+    # Plans eth_getLogs windows over [start_block, end_block] adapting the window size
+    # to the density of the results: a window is bisected when the provider rejects it
+    # or returns (close to) the result cap, and widened when windows are sparse
+
+    def __init__(self, start_block, end_block, batch_size=5000, min_batch_size=1,
+                 max_batch_size=1_000_000, max_results=10_000, near_cap_ratio=0.8, sparse_ratio=0.1):
+        self.next_block = start_block
+        self.end_block = end_block
+        self.batch_size = max(min_batch_size, min(batch_size, max_batch_size))
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.max_results = max_results
+        self.near_cap_ratio = near_cap_ratio
+        self.sparse_ratio = sparse_ratio
+        self.n_calls = 0
+        self.n_splits = 0
+
+    def next_interval(self):
+        # Next window to query or None if the whole range has been covered
+        if self.next_block > self.end_block:
+            return None
+        return (self.next_block, min(self.next_block + self.batch_size - 1, self.end_block))
+
+    def can_split(self, interval):
+        return interval[1] - interval[0] + 1 > self.min_batch_size
+
+    def split(self, interval):
+        # Bisect the window: the next call asks for the first half only
+        self.n_calls += 1
+        self.n_splits += 1
+        self.batch_size = max(self.min_batch_size,
+                              (interval[1] - interval[0] + 1) // 2)
+
+    def is_truncated(self, interval, n_results):
+        # Some providers silently truncate the response at the result cap
+        return self.max_results is not None and n_results >= self.max_results and self.can_split(interval)
+
+    def done(self, interval, n_results):
+        # Move past a window that was fetched successfully and resize the next one
+        self.n_calls += 1
+        self.next_block = interval[1] + 1
+        window_size = interval[1] - interval[0] + 1
+        if self.max_results is None:
+            return
+        if n_results >= self.max_results * self.near_cap_ratio:
+            self.batch_size = max(self.min_batch_size, window_size // 2)
+        elif n_results <= self.max_results * self.sparse_ratio:
+            self.batch_size = min(self.max_batch_size, window_size * 2)
+        else:
+            self.batch_size = window_size
+
+
+def get_logs_adaptive(fetch_logs, start_block, end_block, batch_size=5000, max_results=10_000,
+                      min_batch_size=1, max_batch_size=1_000_000, n_err=15, progress=None, on_batch=None,
+                      collect=True):
+    # Get all logs in [start_block, end_block] using adaptive windows
+    # fetch_logs is a callable receiving (from_block, to_block) and returning a list of logs
+    # on_batch, if given, is called with (interval, logs) after every finished window
+    # With collect=False the logs are only handed to on_batch and not kept in memory
+    # n_err transient errors are allowed per window: the budget is reset after every finished window
+    planner = BlockRangePlanner(start_block, end_block, batch_size=batch_size,
+                                min_batch_size=min_batch_size, max_batch_size=max_batch_size,
+                                max_results=max_results)
+    logs = list()
+    n_window_err = 0
+    interval = planner.next_interval()
+    while interval is not None:
+        try:
+            batch = fetch_logs(*interval)
+        except Exception as e:
+            if is_range_error(e) and planner.can_split(interval):
+                planner.split(interval)
+                interval = planner.next_interval()
+                continue
+            n_window_err += 1
+            if n_window_err == n_err:
+                raise
+            # Rate-limit errors back off exponentially
+            time.sleep(min(.5 * 2 ** (n_window_err - 1), 30) if is_rate_limit_error(e) else .5)
+            continue
+        n_window_err = 0
+        if planner.is_truncated(interval, len(batch)):
+            planner.split(interval)
+            interval = planner.next_interval()
+            continue
+        if collect:
+            logs += batch
+        planner.done(interval, len(batch))
+        if on_batch is not None:
+            on_batch(interval, batch)
+        if progress is not None:
+            progress.update(interval[1] - interval[0] + 1)
+        interval = planner.next_interval()
+    return logs
+
+
+def get_logs_adaptive_parallel(fetch_logs, start_block, end_block, batch_size=5000, max_workers=20,
+                               max_results=10_000, on_batch=None, collect=True, desc='Getting logs'):
+    # Split the block range in one segment per worker, each segment being crawled with adaptive windows
+    segment_size = -(-(end_block - start_block + 1) // max_workers)
+    segments = get_batch_intervals(
+        start_block, end_block, batch_size=segment_size, inclusive=True)
+    with tqdm(total=end_block - start_block + 1, desc=desc, unit='block') as progress:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            log_list = list(pool.map(lambda segment: get_logs_adaptive(
+                fetch_logs, *segment, batch_size=batch_size, max_results=max_results, progress=progress,
+                on_batch=on_batch, collect=collect), segments))
+    return list(itertools.chain(*log_list))
+
+
+def get_events_adaptive(contract_event_function, start_block, end_block, batch_size=5000,
+                        max_workers=20, max_results=10_000, on_batch=None, collect=True):
+    # Get all event data from a contract crawling the block range with adaptive windows
+    def fetch_logs(from_block, to_block):
+        return contract_event_function.get_logs(from_block=from_block, to_block=to_block)
+
+    return get_logs_adaptive_parallel(fetch_logs, start_block, end_block, batch_size=batch_size,
+                                      max_workers=max_workers, max_results=max_results, on_batch=on_batch,
+                                      collect=collect, desc=contract_event_function.event_name)
+
+
+class EventCheckpoint:
+    # On-disk checkpoint of event crawls. Every finished (contract, event, block interval)
+    # is persisted as its own gzip pickle, so a rerun only crawls the missing ranges:
+    # <checkpoint_dir>/<contract_address>/<event_name>/<start_block>_<end_block>.pkl.gz
+    extension = '.pkl.gz'
+
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+
+    def get_event_dir(self, contract_address, event_name):
+        return os.path.join(self.checkpoint_dir, contract_address.lower(), event_name)
+
+    def get_interval_path(self, contract_address, event_name, interval):
+        return os.path.join(self.get_event_dir(contract_address, event_name),
+                            '{}_{}{}'.format(*interval, self.extension))
+
+    def get_done_intervals(self, contract_address, event_name):
+        event_dir = self.get_event_dir(contract_address, event_name)
+        if not os.path.isdir(event_dir):
+            return list()
+        intervals = list()
+        for filename in os.listdir(event_dir):
+            if filename.endswith(self.extension):
+                block_start, block_end = filename[:-len(self.extension)].split('_')
+                intervals.append((int(block_start), int(block_end)))
+        return sorted(intervals)
+
+    def get_pending_intervals(self, contract_address, event_name, start_block, end_block):
+        # Ranges of [start_block, end_block] not covered by any finished interval
+        pending = list()
+        next_block = start_block
+        for block_start, block_end in self.get_done_intervals(contract_address, event_name):
+            if block_end < next_block:
+                continue
+            if block_start > end_block:
+                break
+            if block_start > next_block:
+                pending.append((next_block, block_start - 1))
+            next_block = max(next_block, block_end + 1)
+        if next_block <= end_block:
+            pending.append((next_block, end_block))
+        return pending
+
+    def get_interval_paths(self, contract_address, event_name, start_block, end_block):
+        # Files of the finished intervals overlapping [start_block, end_block]
+        return [self.get_interval_path(contract_address, event_name, interval)
+                for interval in self.get_done_intervals(contract_address, event_name)
+                if interval[1] >= start_block and interval[0] <= end_block]
+
+    def write_interval(self, file_path, events, event_abi=None):
+        with gzip.open(file_path, 'wb') as f:
+            pickle.dump(list(events), f, pickle.HIGHEST_PROTOCOL)
+
+    def save(self, contract_address, event_name, interval, events, event_abi=None):
+        # Write to a temporary file first so that a crash never leaves a partial interval
+        os.makedirs(self.get_event_dir(
+            contract_address, event_name), exist_ok=True)
+        file_path = self.get_interval_path(
+            contract_address, event_name, interval)
+        self.write_interval(file_path + '.tmp', events, event_abi=event_abi)
+        os.replace(file_path + '.tmp', file_path)
+
+    def load(self, contract_address, event_name, start_block, end_block):
+        # Load the events of every finished interval overlapping [start_block, end_block]
+        events = list()
+        for file_path in self.get_interval_paths(contract_address, event_name, start_block, end_block):
+            with gzip.open(file_path, 'rb') as f:
+                events += [event for event in pickle.load(f)
+                           if start_block <= event['blockNumber'] <= end_block]
+        return events
+
+
+def get_abi_type_dtype(abi_type):
+    # Polars dtype used to store an event argument of the given ABI type
+    # Integers wider than 64 bits (e.g. uint256 amounts) are kept exact as decimal strings
+    if abi_type == 'bool':
+        return pl.Boolean
+    if abi_type.startswith(('uint', 'int')) and abi_type[-1] != ']':
+        is_unsigned = abi_type.startswith('uint')
+        n_bits = int(abi_type[4 if is_unsigned else 3:] or 256)
+        if n_bits <= 64:
+            return pl.UInt64 if is_unsigned else pl.Int64
+    return pl.String
+
+
+def to_column_value(value, dtype):
+    if value is None:
+        return None
+    if isinstance(value, (bytes, bytearray)):
+        return '0x' + bytes(value).hex()
+    if dtype == pl.String:
+        return value.lower() if isinstance(value, str) and value.startswith('0x') else str(value)
+    return value
+
+
+def events_to_dataframe(events, event_abi):
+    # Convert web3 event logs into a dataframe with one column per attribute and per event argument
+    # Argument names clashing with the log attributes are prefixed with "args_"
+    columns = {'blockNumber': pl.Int64, 'transactionHash': pl.String, 'blockHash': pl.String,
+               'address': pl.String, 'transactionIndex': pl.Int64, 'logIndex': pl.Int64, 'event': pl.String}
+    args = list()
+    for abi_input in event_abi['inputs']:
+        column = abi_input['name'] if abi_input['name'] not in columns else 'args_' + abi_input['name']
+        columns[column] = get_abi_type_dtype(abi_input['type'])
+        args.append((abi_input['name'], column))
+    data = {column: list() for column in columns}
+    for event in events:
+        data['blockNumber'].append(event['blockNumber'])
+        data['transactionHash'].append(
+            to_column_value(event['transactionHash'], pl.String))
+        data['blockHash'].append(to_column_value(event['blockHash'], pl.String))
+        data['address'].append(event['address'].lower())
+        data['transactionIndex'].append(event['transactionIndex'])
+        data['logIndex'].append(event['logIndex'])
+        data['event'].append(event['event'])
+        for name, column in args:
+            data[column].append(to_column_value(
+                event['args'][name], columns[column]))
+    return pl.DataFrame(data, schema=columns)
+
+
+class ParquetEventSink(EventCheckpoint):
+    # Streaming parquet sink for event crawls. Every finished interval is converted straight to
+    # columnar rows and written to a parquet file partitioned by contract, event and block range:
+    # <sink_dir>/<contract_address>/<event_name>/<start_block>_<end_block>.parquet
+    # As a checkpoint, a rerun only crawls the missing ranges
+    extension = '.parquet'
+
+    def __init__(self, sink_dir, compression='zstd'):
+        super().__init__(sink_dir)
+        self.compression = compression
+
+    def write_interval(self, file_path, events, event_abi=None):
+        events_to_dataframe(events, event_abi).write_parquet(
+            file_path, compression=self.compression)
+
+    def load(self, contract_address, event_name, start_block, end_block):
+        # Lazily scan the events in [start_block, end_block] sorted in chain order
+        file_paths = self.get_interval_paths(
+            contract_address, event_name, start_block, end_block)
+        if not file_paths:
+            return pl.LazyFrame()
+        return (pl.scan_parquet(file_paths)
+                .filter(pl.col('blockNumber').is_between(start_block, end_block))
+                .sort(['blockNumber', 'transactionIndex', 'logIndex']))
+
+
+def get_events_checkpointed(contract_event_function, start_block, end_block, checkpoint, batch_size=5000,
+                            max_workers=20, adaptive=False, max_results=10_000):
+    # Get all event data from a contract crawling only the intervals missing from the checkpoint
+    # Finished intervals are not kept in memory; the result is loaded back from the checkpoint
+    contract_address = contract_event_function.address
+    event_name = contract_event_function.event_name
+
+    def save_interval(interval, events):
+        checkpoint.save(contract_address, event_name, interval, events,
+                        event_abi=contract_event_function.abi)
+
+    def get_and_save_events(params):
+        events = get_events_from_contract(params)
+        save_interval((params['start_block'], params['end_block']), events)
+
+    pending = checkpoint.get_pending_intervals(
+        contract_address, event_name, start_block, end_block)
+    print('{}: {} pending block ranges'.format(event_name, len(pending)))
+    for range_start, range_end in pending:
+        if adaptive:
+            get_events_adaptive(contract_event_function, range_start, range_end, batch_size=batch_size,
+                                max_workers=max_workers, max_results=max_results, on_batch=save_interval,
+                                collect=False)
+            continue
+        intervals = [{'contract_event_function': contract_event_function,
+                      'start_block': block_start, 'end_block': block_end}
+                     for block_start, block_end in get_batch_intervals(range_start, range_end, batch_size, inclusive=True)]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            list(tqdm(pool.map(get_and_save_events, intervals),
+                 total=len(intervals), desc=event_name))
+    return checkpoint.load(contract_address, event_name, start_block, end_block)
+
+
+def get_events(contract_event_function, start_block, end_block, batch_size=5000, max_workers=20,
+               adaptive=False, max_results=10_000, checkpoint=None):
     # Get all event data from a contract in batches
     # This is a multithreading code and run faster than the previous version
+    if checkpoint is not None:
+        return get_events_checkpointed(contract_event_function, start_block, end_block, checkpoint,
+                                       batch_size=batch_size, max_workers=max_workers,
+                                       adaptive=adaptive, max_results=max_results)
+    if adaptive:
+        return get_events_adaptive(contract_event_function, start_block, end_block, batch_size=batch_size,
+                                   max_workers=max_workers, max_results=max_results)
     event_list = list()
     dict_keys = ['contract_event_function', 'start_block', 'end_block']
     intervals = get_batch_intervals(
@@ -104,15 +556,144 @@ def get_events(contract_event_function, start_block, end_block, batch_size=5000,
     return event_list
 
 
-def get_all_events_from_contract(contract, start_block, end_block, batch_size=5000, max_workers=20, events=None):
+def get_event_decoders(contract, events=None):
+    # Precompiled topic_0 -> event ABI table used to decode raw logs locally
+    # Anonymous events have no topic_0 and cannot be identified
+    event_names = set(event.event_name for event in events) if events else None
+    decoders = dict()
+    for event_abi in contract.abi:
+        if event_abi['type'] != 'event' or event_abi.get('anonymous'):
+            continue
+        if event_names is not None and event_abi['name'] not in event_names:
+            continue
+        decoders[Web3.to_hex(event_abi_to_log_topic(event_abi))] = event_abi
+    return decoders
+
+
+def decode_logs(codec, logs, decoders, skipped=None):
+    # Decode raw logs into web3 event data grouped by event name
+    # Logs with an unknown topic_0 or not matching the ABI (e.g. ERC721 Transfer, with one more indexed
+    # topic) are skipped, the latter counted per event name in skipped (a Counter)
+    events = dict()
+    for log in logs:
+        if not log['topics']:
+            continue
+        event_abi = decoders.get(Web3.to_hex(log['topics'][0]))
+        if event_abi is None:
+            continue
+        try:
+            event = get_event_data(codec, event_abi, log)
+        except (LogTopicError, MismatchedABI, DecodingError):
+            if skipped is not None:
+                skipped[event_abi['name']] += 1
+            continue
+        events.setdefault(event_abi['name'], list()).append(event)
+    return events
+
+
+def get_all_events_single_pass(contract, start_block, end_block, batch_size=5000, max_workers=20, events=None,
+                               adaptive=False, max_results=10_000, checkpoint=None):
+    # Get all events data from a contract fetching the raw logs of the contract address once per
+    # block range (filtered to the topic_0 of the requested events) and decoding them locally,
+    # so the crawl cost does not depend on the number of events
+    decoders = get_event_decoders(contract, events=events)
+    if not decoders:
+        # topics=[[]] would match every log of the contract
+        raise ValueError('Error: No event to decode for {}'.format(contract.address))
+    event_abis = {event_abi['name']: event_abi for event_abi in decoders.values()}
+    filter_params = {'address': contract.address,
+                     'topics': [list(decoders)]}
+    # Logs not matching the ABI of their event, over all the intervals (decoded by the fetching threads)
+    skipped = Counter()
+    skipped_lock = threading.Lock()
+
+    def fetch_logs(from_block, to_block):
+        return contract.w3.eth.get_logs(filter_params=dict(filter_params, fromBlock=from_block, toBlock=to_block))
+
+    def save_interval(interval, logs):
+        # Save the decoded events of every event type for the parts of the interval it still misses
+        interval_skipped = Counter()
+        interval_events = decode_logs(
+            contract.w3.codec, logs, decoders, skipped=interval_skipped)
+        with skipped_lock:
+            skipped.update(interval_skipped)
+        for event_name, event_abi in event_abis.items():
+            for block_start, block_end in checkpoint.get_pending_intervals(contract.address, event_name, *interval):
+                checkpoint.save(contract.address, event_name, (block_start, block_end),
+                                [event for event in interval_events.get(event_name, list())
+                                 if block_start <= event['blockNumber'] <= block_end],
+                                event_abi=event_abi)
+
+    def fetch_and_save_logs(interval):
+        logs = get_logs_with_retry(fetch_logs, *interval)
+        if checkpoint is not None:
+            save_interval(interval, logs)
+            return list()
+        return logs
+
+    pending = [(start_block, end_block)]
+    if checkpoint is not None:
+        # A range is crawled again if any of the event types misses it
+        pending = list()
+        for block_start, block_end in sorted(itertools.chain(*(checkpoint.get_pending_intervals(
+                contract.address, event_name, start_block, end_block) for event_name in event_abis))):
+            if pending and block_start <= pending[-1][1] + 1:
+                pending[-1] = (pending[-1][0], max(pending[-1][1], block_end))
+            else:
+                pending.append((block_start, block_end))
+    logs = list()
+    for range_start, range_end in pending:
+        if adaptive:
+            logs += get_logs_adaptive_parallel(fetch_logs, range_start, range_end, batch_size=batch_size,
+                                               max_workers=max_workers, max_results=max_results,
+                                               on_batch=save_interval if checkpoint is not None else None,
+                                               collect=checkpoint is None, desc='Getting logs')
+            continue
+        intervals = get_batch_intervals(
+            range_start, range_end, batch_size, inclusive=True)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            log_list = list(tqdm(pool.map(fetch_and_save_logs, intervals),
+                                 total=len(intervals), desc='Getting logs'))
+        logs += itertools.chain(*log_list)
+
+    contract_events = {event_name: list() for event_name in event_abis}
+    if checkpoint is None:
+        contract_events.update(decode_logs(
+            contract.w3.codec, logs, decoders, skipped=skipped))
+    for event_name, n_skipped in skipped.items():
+        print('{}: {} logs skipped (not matching the event ABI)'.format(
+            event_name, n_skipped))
+    if checkpoint is not None:
+        return {event_name: checkpoint.load(contract.address, event_name, start_block, end_block)
+                for event_name in event_abis}
+    return contract_events
+
+
+def get_all_events_from_contract(contract, start_block, end_block, batch_size=5000, max_workers=20, events=None,
+                                 adaptive=False, max_results=10_000, checkpoint_dir=None, sink_dir=None,
+                                 single_pass=False):
     # Get all events data from a contract
+    # With checkpoint_dir every finished block interval is persisted and a rerun resumes the crawl
+    # With sink_dir the intervals are streamed to parquet and a LazyFrame is returned per event
+    # With single_pass the logs of all events are fetched at once and decoded locally
+    checkpoint = None
+    if sink_dir:
+        checkpoint = ParquetEventSink(sink_dir)
+    elif checkpoint_dir:
+        checkpoint = EventCheckpoint(checkpoint_dir)
+    if single_pass:
+        return get_all_events_single_pass(contract, start_block, end_block, batch_size=batch_size,
+                                          max_workers=max_workers, events=events, adaptive=adaptive,
+                                          max_results=max_results, checkpoint=checkpoint)
     contract_events = dict()
     if not events:
         events = contract.events
     for event in events:
         contract_events[event.event_name] = get_events(contract_event_function=contract.events[event.event_name],
                                                        start_block=start_block, end_block=end_block,
-                                                       batch_size=batch_size, max_workers=max_workers)
+                                                       batch_size=batch_size, max_workers=max_workers,
+                                                       adaptive=adaptive, max_results=max_results,
+                                                       checkpoint=checkpoint)
     return contract_events
 
 
@@ -120,7 +701,105 @@ def get_block(params):
     return params['lib'].eth.get_block(params['block_number'])
 
 
-def get_blocks(w3, block_numbers, max_workers=20):
+def get_rpc_session(pool_maxsize=20):
+    # Keep-alive HTTP session shared by the JSON-RPC batch requests
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def make_batch_request(session, endpoint_uri, calls, timeout=60):
+    # Send a list of (method, params) calls as a single JSON-RPC batch request
+    # Returns the results and the errors of every call, in the order of the calls
+    payload = [{'jsonrpc': '2.0', 'id': call_id, 'method': method, 'params': params}
+               for call_id, (method, params) in enumerate(calls)]
+    rq = session.post(endpoint_uri, json=payload, timeout=timeout)
+    rq.raise_for_status()
+    response = rq.json()
+    if not isinstance(response, list):
+        # The provider rejected the whole batch (e.g. batch too large or rate limited)
+        raise ValueError(response.get('error', response))
+    results = [None] * len(calls)
+    errors = ['Missing response'] * len(calls)
+    for item in response:
+        call_id = item.get('id')
+        if not isinstance(call_id, int) or not 0 <= call_id < len(calls):
+            continue
+        results[call_id] = item.get('result')
+        errors[call_id] = item.get('error')
+    return results, errors
+
+
+def get_batched(w3, calls, batch_size=200, max_workers=4, n_err=5, session=None, timeout=60, desc='Gathering...'):
+    # Run (method, params) calls packed in JSON-RPC batches of batch_size calls
+    # Calls failing individually are retried in later batches up to n_err times
+    # and are returned as None if they keep failing
+    endpoint_uri = w3.provider.endpoint_uri
+    if session is None:
+        session = get_rpc_session(pool_maxsize=max_workers)
+    results = [None] * len(calls)
+    pending = list(range(len(calls)))
+    with tqdm(total=len(calls), desc=desc) as progress:
+        while pending and n_err > 0:
+            failed = list()
+            batches = [pending[i:i + batch_size]
+                       for i in range(0, len(pending), batch_size)]
+
+            def run_batch(call_ids):
+                try:
+                    return call_ids, make_batch_request(
+                        session, endpoint_uri, [calls[call_id] for call_id in call_ids], timeout=timeout)
+                except Exception as e:
+                    return call_ids, ([None] * len(call_ids), [str(e)] * len(call_ids))
+
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                for call_ids, (batch_results, batch_errors) in pool.map(run_batch, batches):
+                    for call_id, result, error in zip(call_ids, batch_results, batch_errors):
+                        if error is None:
+                            results[call_id] = result
+                            progress.update(1)
+                        else:
+                            failed.append(call_id)
+            pending = failed
+            n_err -= 1
+            if pending and n_err > 0:
+                time.sleep(.5)
+    if pending:
+        print('Error: {} calls failed after all retries'.format(len(pending)))
+    return results
+
+
+def format_rpc_result(w3, method, result):
+    # Apply the web3 result formatters so batched results match w3.eth.get_* outputs
+    if result is None:
+        return None
+    return AttributeDict.recursive(get_result_formatters(method, w3.eth)(result))
+
+
+def to_hex_hash(tx_hash):
+    if isinstance(tx_hash, str):
+        return tx_hash
+    return Web3.to_hex(tx_hash)
+
+
+def get_blocks_batched(w3, block_numbers, batch_size=200, max_workers=4, raw=False):
+    # Get blocks through JSON-RPC batch requests
+    # With raw=True the JSON results are returned without the web3 formatting
+    calls = [(RPC.eth_getBlockByNumber, [hex(block_number), False])
+             for block_number in block_numbers]
+    blocks = get_batched(w3, calls, batch_size=batch_size,
+                         max_workers=max_workers, desc='Gathering blocks...')
+    if raw:
+        return blocks
+    return [format_rpc_result(w3, RPC.eth_getBlockByNumber, block) for block in blocks]
+
+
+def get_blocks(w3, block_numbers, max_workers=20, batched=False, batch_size=200):
+    if batched:
+        return get_blocks_batched(w3, block_numbers, batch_size=batch_size, max_workers=max_workers)
     blocks = []
     print('Prepearing to gather blocks...')
     params = [{'lib': w3, 'block_number': block_number}
@@ -136,7 +815,14 @@ def to_checksum_address(address):
     return Web3.to_checksum_address(address.lower())
 
 
-def get_logs_from_contract(address, fromBlock, toBlock, batch_size=500):
+def get_logs_from_contract(w3, address, fromBlock, toBlock, batch_size=500, adaptive=False, max_results=10_000):
+    if adaptive:
+        def fetch_logs(block_start, block_end):
+            return w3.eth.get_logs(filter_params={
+                'address': address, 'fromBlock': block_start, 'toBlock': block_end})
+        with tqdm(total=toBlock - fromBlock + 1, desc='Getting logs', ascii=True) as progress:
+            return get_logs_adaptive(fetch_logs, fromBlock, toBlock, batch_size=batch_size,
+                                     max_results=max_results, progress=progress)
     logs = []
     intervals = get_batch_intervals(fromBlock, toBlock, batch_size=batch_size)
     try:
@@ -160,7 +846,30 @@ def get_transaction(params):
     return tx_data
 
 
-def get_transactions(w3, txs_hashes, max_workers=20):
+def get_transactions_batched(w3, txs_hashes, batch_size=200, max_workers=4, raw=False):
+    # Get transactions and their receipts through JSON-RPC batch requests
+    # Every hash adds two calls to the batch: eth_getTransactionByHash and eth_getTransactionReceipt
+    # With raw=True the JSON results are returned without the web3 formatting
+    calls = list()
+    for tx_hash in txs_hashes:
+        tx_hash = to_hex_hash(tx_hash)
+        calls.append((RPC.eth_getTransactionByHash, [tx_hash]))
+        calls.append((RPC.eth_getTransactionReceipt, [tx_hash]))
+    results = get_batched(w3, calls, batch_size=batch_size,
+                          max_workers=max_workers, desc='Gathering transactions...')
+    txs = list()
+    for tx, receipt in zip(results[::2], results[1::2]):
+        if not raw:
+            tx = format_rpc_result(w3, RPC.eth_getTransactionByHash, tx)
+            receipt = format_rpc_result(
+                w3, RPC.eth_getTransactionReceipt, receipt)
+        txs.append({'tx': tx, 'receipt': receipt})
+    return txs
+
+
+def get_transactions(w3, txs_hashes, max_workers=20, batched=False, batch_size=200):
+    if batched:
+        return get_transactions_batched(w3, txs_hashes, batch_size=batch_size, max_workers=max_workers)
     txs = []
     params = [{'lib': w3, 'tx_hash': tx_hash}
               for tx_hash in txs_hashes]
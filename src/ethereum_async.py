@@ -0,0 +1,145 @@
+# Asynchronous data collection
+# asyncio counterpart of the ThreadPoolExecutor collectors of ethereum.py built on AsyncWeb3.
+# A single AsyncCollector bounds the number of in-flight requests and shares a token-bucket
+# rate limiter across all of its collectors, so get_events, get_blocks and get_transactions
+# can run concurrently without exceeding the provider allowance.
+#
+# In a notebook await the coroutines directly:
+#   collector = AsyncCollector(eth_node, max_concurrency=300, requests_per_second=250)
+#   await collector.connect()
+#   blocks = await collector.get_blocks(block_numbers)
+
+import asyncio
+import itertools
+import time
+
+from aiohttp import ClientResponseError, ClientSession, ClientTimeout, TCPConnector
+from tqdm.notebook import tqdm
+from web3 import AsyncHTTPProvider, AsyncWeb3
+
+from ethereum import get_batch_intervals
+
+
+class TokenBucket:
+    # Token-bucket rate limiter: refills rate tokens per second up to capacity
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, tokens=1):
+        async with self.lock:
+            self.refill()
+            while self.tokens < tokens:
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= tokens
+
+    def penalize(self, seconds):
+        # Drain the bucket after the provider answered 429 so every collector backs off
+        self.refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class AsyncCollector:
+
+    def __init__(self, endpoint_uri, max_concurrency=200, requests_per_second=100, n_err=5, timeout=60):
+        self.endpoint_uri = endpoint_uri
+        self.max_concurrency = max_concurrency
+        self.n_err = n_err
+        self.timeout = timeout
+        self.rate_limiter = TokenBucket(requests_per_second)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        # Retries are handled by the collector so that they also go through the rate limiter
+        self.w3 = AsyncWeb3(AsyncHTTPProvider(
+            endpoint_uri, exception_retry_configuration=None))
+
+    async def connect(self):
+        # Use a connection pool as large as the concurrency limit (aiohttp defaults to 100)
+        session = ClientSession(connector=TCPConnector(limit=self.max_concurrency),
+                                timeout=ClientTimeout(total=self.timeout))
+        await self.w3.provider.cache_async_session(session)
+        return await self.w3.is_connected()
+
+    async def disconnect(self):
+        await self.w3.provider.disconnect()
+
+    async def call(self, func, *args, **kwargs):
+        # Rate limited and concurrency bounded call with exponential backoff on failures
+        n_err = self.n_err
+        while True:
+            await self.rate_limiter.acquire()
+            async with self.semaphore:
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    n_err -= 1
+                    if n_err == 0:
+                        raise
+                    backoff = .5 * 2 ** (self.n_err - n_err - 1)
+                    if isinstance(e, ClientResponseError) and e.status == 429:
+                        self.rate_limiter.penalize(backoff)
+            await asyncio.sleep(backoff)
+
+    async def map(self, func, items, desc=None):
+        # Apply the coroutine function func to every item with at most max_concurrency workers
+        # Workers pull items from a shared iterator so pending coroutines are never materialised
+        items = list(items)
+        results = [None] * len(items)
+        indexes = iter(range(len(items)))
+
+        async def worker():
+            for index in indexes:
+                results[index] = await func(items[index])
+                progress.update(1)
+
+        with tqdm(total=len(items), desc=desc) as progress:
+            await asyncio.gather(*(worker() for _ in range(min(self.max_concurrency, len(items)))))
+        return results
+
+    def get_contract(self, contract_address, abi):
+        return self.w3.eth.contract(address=contract_address, abi=abi)
+
+    async def get_block(self, block_number):
+        return await self.call(self.w3.eth.get_block, block_number)
+
+    async def get_blocks(self, block_numbers):
+        return await self.map(self.get_block, block_numbers, desc='Gathering blocks...')
+
+    async def get_transaction(self, tx_hash):
+        tx, receipt = await asyncio.gather(self.call(self.w3.eth.get_transaction, tx_hash),
+                                           self.call(self.w3.eth.get_transaction_receipt, tx_hash))
+        return {'tx': tx, 'receipt': receipt}
+
+    async def get_transactions(self, txs_hashes):
+        return await self.map(self.get_transaction, txs_hashes, desc='Gathering transactions...')
+
+    async def get_events(self, contract_event_function, start_block, end_block, batch_size=5000):
+        # contract_event_function must come from a contract created with get_contract
+        intervals = get_batch_intervals(
+            start_block, end_block, batch_size=batch_size, inclusive=True)
+
+        async def get_logs(interval):
+            return await self.call(contract_event_function.get_logs, from_block=interval[0], to_block=interval[1])
+
+        event_list = await self.map(get_logs, intervals, desc=contract_event_function.event_name)
+        return list(itertools.chain(*event_list))
+
+    async def get_all_events_from_contract(self, contract, start_block, end_block, batch_size=5000, events=None):
+        # Event types are crawled concurrently; the concurrency and rate limits are shared
+        if not events:
+            events = contract.events
+        event_names = [event.event_name for event in events]
+        event_lists = await asyncio.gather(*(self.get_events(contract.events[event_name], start_block, end_block,
+                                                             batch_size=batch_size)
+                                             for event_name in event_names))
+        return dict(zip(event_names, event_lists))
@@ -0,0 +1,416 @@
+# Transfer graph
+# Array-backed replacement of the networkx MultiDiGraph of notebook 03 (build_graph).
+# Addresses are mapped to integer node ids (their position in the sorted address array) and every
+# transfer is an edge with parallel amount, block number and timestamp arrays. The forward and the
+# reverse adjacency are two compressed sparse row (CSR) permutations of the same edge arrays, so
+# traversals in either direction need no graph.reverse() copy.
+#
+#   graph = TransferGraph.from_parquet(os.path.join(data_dir, 'uniswap_transfer.parquet'),
+#                                      exclude_senders=airdrop_addresses, protocol='uniswap')
+#   graph.successors('0x...')
+#
+# save() writes the graph as a directory with the address dictionary in Arrow IPC and every array in
+# an uncompressed .npy file; load() maps them, so opening a graph is near-instant and pages are only
+# read as a traversal touches them. convert_gpickle() converts the gzip pickles of notebook 03.
+
+import gzip
+import json
+import os
+import pickle
+
+import numpy as np
+import polars as pl
+
+# Arrays of the on-disk format (one uncompressed .npy file each, memory-mapped when loading)
+NODE_ARRAYS = ['out_offsets', 'in_offsets']
+EDGE_ARRAYS = ['sources', 'targets', 'amounts', 'block_numbers', 'timestamps',
+               'out_edges', 'in_edges', 'out_neighbors', 'in_neighbors']
+# Timestamp of the transfers without one (e.g. a null block timestamp or an unparsable str(datetime)):
+# the int64 minimum, which no block has
+MISSING_TIMESTAMP = np.iinfo(np.int64).min
+
+
+class TransferGraph:
+
+    def __init__(self, addresses, sources, targets, amounts=None, block_numbers=None, timestamps=None,
+                 protocol=None):
+        # addresses: sorted unique addresses (node id -> address)
+        # sources, targets: node ids of every edge; amounts, block_numbers, timestamps: edge attributes
+        self.addresses = pl.Series('address', addresses, dtype=pl.String)
+        self.sources = np.asarray(sources, dtype=np.int32)
+        self.targets = np.asarray(targets, dtype=np.int32)
+        self.amounts = None if amounts is None else np.asarray(
+            amounts, dtype=np.float64)
+        self.block_numbers = None if block_numbers is None else np.asarray(
+            block_numbers, dtype=np.int64)
+        # Epoch seconds, MISSING_TIMESTAMP for the nulls (NaN are nulls, numpy would cast them to any integer)
+        self.timestamps = None if timestamps is None else pl.Series(
+            timestamps, nan_to_null=True).cast(pl.Int64).fill_null(MISSING_TIMESTAMP).to_numpy()
+        self.protocol = protocol
+        self.out_offsets, self.out_edges = self.build_csr(self.sources)
+        self.in_offsets, self.in_edges = self.build_csr(self.targets)
+        # Neighbours in CSR order, so traversals gather them without going through the edge ids
+        self.out_neighbors = self.targets[self.out_edges]
+        self.in_neighbors = self.sources[self.in_edges]
+
+    def build_csr(self, nodes):
+        # Offsets of every node and the edge ids grouped by node (in transfer order within a node)
+        counts = np.bincount(nodes, minlength=self.number_of_nodes())
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets, np.argsort(nodes, kind='stable').astype(np.int64)
+
+    @staticmethod
+    def from_dataframe(df, sender='from', receiver='to', amount='amount', block_number='blockNumber',
+                       timestamp='timestamp', exclude_senders=None, protocol=None):
+        # Build the graph from the columns of a <protocol>_transfer table (DataFrame or LazyFrame)
+        # Transfers sent by exclude_senders (e.g. the airdrop contracts) are not edges
+        if isinstance(df, pl.DataFrame):
+            df = df.lazy()
+        schema = df.collect_schema()
+        columns = [pl.col(sender).alias('sender'),
+                   pl.col(receiver).alias('receiver')]
+        if amount in schema:
+            columns.append(pl.col(amount).cast(pl.Float64).alias('amount'))
+        if block_number in schema:
+            columns.append(pl.col(block_number).alias('block_number'))
+        if timestamp in schema:
+            columns.append((pl.col(timestamp).dt.epoch('s') if schema[timestamp] == pl.Datetime
+                            else pl.col(timestamp)).cast(pl.Int64).fill_null(MISSING_TIMESTAMP).alias('timestamp'))
+        if exclude_senders:
+            df = df.filter(~pl.col(sender).is_in(list(exclude_senders)))
+        edges = df.select(columns).collect()
+        # Transfers without a sender or a receiver would get null node ids
+        n_nulls = edges.height - edges.drop_nulls(['sender', 'receiver']).height
+        if n_nulls:
+            print("Dropped {} transfers without sender or receiver".format(n_nulls))
+            edges = edges.drop_nulls(['sender', 'receiver'])
+        addresses = pl.concat(
+            [edges['sender'], edges['receiver']]).unique().sort()
+        # Node ids by hash joins on the address dictionary
+        nodes = addresses.to_frame('address').with_row_index('id')
+        ids = (edges
+               .select(['sender', 'receiver'])
+               .join(nodes.rename({'address': 'sender', 'id': 'source'}), on='sender', how='left',
+                     maintain_order='left')
+               .join(nodes.rename({'address': 'receiver', 'id': 'target'}), on='receiver', how='left',
+                     maintain_order='left'))
+        return TransferGraph(
+            addresses,
+            ids['source'].to_numpy(),
+            ids['target'].to_numpy(),
+            amounts=edges['amount'].to_numpy() if 'amount' in edges.columns else None,
+            block_numbers=edges['block_number'].to_numpy(
+            ) if 'block_number' in edges.columns else None,
+            timestamps=edges['timestamp'].to_numpy(
+            ) if 'timestamp' in edges.columns else None,
+            protocol=protocol)
+
+    @staticmethod
+    def from_networkx(G):
+        # Convert a MultiDiGraph built by build_graph (notebook 03), e.g. a full_graph_<protocol>.gpickle
+        edges = pl.DataFrame([(source, target, data.get('amount'), data.get('block_number'), data.get('timestamp'))
+                              for source, target, data in G.edges(data=True)],
+                             schema={'from': pl.String, 'to': pl.String, 'amount': pl.Float64,
+                                     'blockNumber': pl.Int64, 'timestamp': pl.String}, orient='row')
+        # Edge timestamps are stored as str(datetime)
+        edges = edges.with_columns(pl.col('timestamp').str.to_datetime(strict=False))
+        # Nodes without edges are dropped: they are unreachable anyway
+        return TransferGraph.from_dataframe(edges, protocol=G.graph.get('protocol'))
+
+    @staticmethod
+    def from_parquet(file_path, sender='from', receiver='to', **kwargs):
+        return TransferGraph.from_dataframe(pl.scan_parquet(file_path), sender=sender, receiver=receiver, **kwargs)
+
+    def save(self, directory):
+        # Write the arrays next to each other, then the metadata last so that a partial write is not loaded
+        os.makedirs(directory, exist_ok=True)
+        if TransferGraph.is_saved(directory):
+            os.remove(os.path.join(directory, 'graph.json'))
+        self.addresses.to_frame().write_ipc(
+            os.path.join(directory, 'addresses.arrow'), compression='uncompressed')
+        for name in NODE_ARRAYS + EDGE_ARRAYS:
+            values = getattr(self, name)
+            if values is not None:
+                np.save(os.path.join(directory, name + '.npy'), values)
+        with open(os.path.join(directory, 'graph.json'), 'w') as f:
+            json.dump({'protocol': self.protocol, 'n_nodes': self.number_of_nodes(),
+                       'n_edges': self.number_of_edges(),
+                       'arrays': [name for name in NODE_ARRAYS + EDGE_ARRAYS if getattr(self, name) is not None]}, f)
+
+    @staticmethod
+    def load(directory, mmap=True):
+        # Open a graph written by save(): the arrays are memory-mapped (read in memory with mmap=False)
+        with open(os.path.join(directory, 'graph.json')) as f:
+            metadata = json.load(f)
+        graph = TransferGraph.__new__(TransferGraph)
+        graph.protocol = metadata['protocol']
+        graph.addresses = pl.read_ipc(os.path.join(directory, 'addresses.arrow'),
+                                      memory_map=mmap)['address']
+        for name in NODE_ARRAYS + EDGE_ARRAYS:
+            setattr(graph, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='r' if mmap else None)
+                    if name in metadata['arrays'] else None)
+        return graph
+
+    @staticmethod
+    def is_saved(directory):
+        return os.path.exists(os.path.join(directory, 'graph.json'))
+
+    def number_of_nodes(self):
+        return len(self.addresses)
+
+    def number_of_edges(self):
+        return len(self.sources)
+
+    def get_node_ids(self, addresses):
+        # Node id of every address (-1 for addresses that are not in the graph)
+        addresses = pl.Series(addresses, dtype=pl.String)
+        if self.number_of_nodes() == 0:
+            return np.full(len(addresses), -1, dtype=np.int64)
+        ids = np.minimum(self.addresses.search_sorted(
+            addresses).to_numpy().astype(np.int64), self.number_of_nodes() - 1)
+        found = (self.addresses.gather(ids) == addresses).fill_null(
+            False).to_numpy()
+        return np.where(found, ids, -1)
+
+    def get_node_id(self, address):
+        return int(self.get_node_ids([address])[0])
+
+    def has_node(self, address):
+        return self.get_node_id(address) >= 0
+
+    def get_addresses(self, node_ids):
+        return self.addresses.gather(np.asarray(node_ids, dtype=np.int64))
+
+    def get_edges(self, node, reverse=False):
+        # Edge ids leaving the node (entering it with reverse=True), in transfer order
+        if isinstance(node, str):
+            node = self.get_node_id(node)
+            if node < 0:
+                return np.zeros(0, dtype=np.int64)
+        offsets, edges = (self.in_offsets, self.in_edges) if reverse else (
+            self.out_offsets, self.out_edges)
+        return edges[offsets[node]:offsets[node + 1]]
+
+    def get_neighbors(self, node, reverse=False):
+        # Node ids of the successors (predecessors with reverse=True), one per edge
+        if isinstance(node, str):
+            node = self.get_node_id(node)
+            if node < 0:
+                return np.zeros(0, dtype=np.int32)
+        offsets, neighbors = self.get_adjacency(reverse=reverse)
+        return neighbors[offsets[node]:offsets[node + 1]]
+
+    def successors(self, address):
+        return self.get_addresses(np.unique(self.get_neighbors(address)))
+
+    def predecessors(self, address):
+        return self.get_addresses(np.unique(self.get_neighbors(address, reverse=True)))
+
+    def get_adjacency(self, reverse=False):
+        # CSR (offsets, neighbours) of the graph or of its reverse
+        if reverse:
+            return self.in_offsets, self.in_neighbors
+        return self.out_offsets, self.out_neighbors
+
+    def out_degree(self):
+        return np.diff(self.out_offsets)
+
+    def in_degree(self):
+        return np.diff(self.in_offsets)
+
+    def to_dataframe(self):
+        # Edge list with the addresses and the edge attributes
+        columns = [self.get_addresses(self.sources).alias('sender'),
+                   self.get_addresses(self.targets).alias('receiver')]
+        for name, values in [('amount', self.amounts), ('block_number', self.block_numbers),
+                             ('timestamp', self.timestamps)]:
+            if values is not None:
+                columns.append(pl.Series(name, values))
+        df = pl.DataFrame(columns)
+        if 'timestamp' in df.columns:
+            df = df.with_columns(pl.col('timestamp').replace(MISSING_TIMESTAMP, None))
+        return df
+
+    def temporal_hops(self, claimants, claim_blocks, exchange_addresses):
+        # Minimum hops and earliest arrival at an exchange of the tokens of every claimant after its claim
+        # block (null when no exchange is reachable), see earliest_arrival
+        if self.block_numbers is None:
+            raise ValueError('Error: temporal_hops needs the block numbers of the transfers')
+        claims = (pl.DataFrame({'address': pl.Series(claimants, dtype=pl.String),
+                                'claim_block': pl.Series(claim_blocks, dtype=pl.Int64)})
+                  .group_by('address').agg(pl.col('claim_block').min())
+                  .sort('address'))
+        nodes = self.get_node_ids(claims['address'])
+        is_exchange = np.zeros(self.number_of_nodes(), dtype=bool)
+        exchanges = self.get_node_ids(list(exchange_addresses))
+        is_exchange[exchanges[exchanges >= 0]] = True
+        in_graph = (nodes >= 0) & ~is_exchange[np.maximum(nodes, 0)]
+        hops, arrivals = earliest_arrival(np.asarray(self.sources), np.asarray(self.targets),
+                                          np.asarray(self.block_numbers), is_exchange,
+                                          nodes[in_graph], claims['claim_block'].to_numpy()[in_graph])
+        claims = claims.filter(pl.Series(in_graph)).with_columns(
+            pl.Series('hops', hops).replace(-1, None),
+            pl.Series('arrival_block', arrivals).replace(-1, None))
+        if self.timestamps is not None:
+            # Timestamp of the arrival block from the edges of that block that have one
+            blocks = (pl.DataFrame({'arrival_block': np.asarray(self.block_numbers),
+                                    'arrival_timestamp': np.asarray(self.timestamps)})
+                      .filter(pl.col('arrival_timestamp') != MISSING_TIMESTAMP)
+                      .group_by('arrival_block').agg(pl.col('arrival_timestamp').min()))
+            claims = claims.join(blocks.with_columns(pl.from_epoch(pl.col('arrival_timestamp'))),
+                                 on='arrival_block', how='left', maintain_order='left')
+        return claims
+
+    def multi_source_bfs(self, sources, reverse=False, max_hops=None, targets=None):
+        # Hop distance of every node from the nearest source (-1 if unreached)
+        # reverse=True follows the edges backwards
+        offsets, neighbors = self.get_adjacency(reverse=reverse)
+        return multi_source_bfs(offsets, neighbors, sources, max_hops=max_hops, targets=targets)
+
+
+def convert_gpickle(gpickle_path, directory):
+    # Convert a full_graph_<protocol>.gpickle (gzip pickle of a networkx MultiDiGraph) to the mmap format
+    with gzip.open(gpickle_path, 'rb') as f:
+        graph = TransferGraph.from_networkx(pickle.load(f))
+    graph.save(directory)
+    print("Converted {} ({} nodes and {} edges)".format(
+        gpickle_path, graph.number_of_nodes(), graph.number_of_edges()))
+    return graph
+
+
+def multi_source_bfs(offsets, neighbors, sources, max_hops=None, targets=None):
+    # Level-synchronous BFS over a CSR adjacency (offsets, neighbors), which may be memory-mapped arrays:
+    # every level expands the whole frontier with array operations. Returns the hop distance of every
+    # node from the nearest source (-1 if unreached). The search stops after max_hops levels, or once
+    # all the targets (node ids) are labelled
+    n_nodes = len(offsets) - 1
+    distances = np.full(n_nodes, -1, dtype=np.int32)
+    frontier = np.unique(np.asarray(sources, dtype=np.int64))
+    frontier = frontier[frontier >= 0]
+    distances[frontier] = 0
+    remaining = None
+    if targets is not None:
+        is_target = np.zeros(n_nodes, dtype=bool)
+        targets = np.asarray(targets, dtype=np.int64)
+        is_target[targets[targets >= 0]] = True
+        is_target[frontier] = False
+        remaining = np.count_nonzero(is_target)
+    hops = 0
+    while len(frontier) and (max_hops is None or hops < max_hops) and remaining != 0:
+        starts = offsets[frontier]
+        counts = offsets[frontier + 1] - starts
+        total = int(counts.sum())
+        if total == 0:
+            break
+        # Positions of all the neighbours of the frontier in the CSR arrays
+        positions = np.repeat(starts - (np.cumsum(counts) - counts), counts) + \
+            np.arange(total, dtype=np.int64)
+        frontier = neighbors[positions]
+        frontier = np.unique(frontier[distances[frontier] < 0])
+        hops += 1
+        distances[frontier] = hops
+        if remaining is not None:
+            remaining -= np.count_nonzero(is_target[frontier])
+    return distances
+
+
+def earliest_arrival(sources, targets, block_numbers, is_exchange, claimants, claim_blocks):
+    # Time-respecting paths from every claimant to the exchanges: a path only uses transfers at or after
+    # the claim block, in non-decreasing block order, and stops at the first exchange it reaches
+    # One sweep over the edges sorted by block number, from the latest block to the earliest, keeps for
+    # every node the minimum hops and the earliest arrival block at an exchange over the paths leaving
+    # it at or after the current block; the value of each claimant (one per node) is read when the sweep
+    # passes its claim block, so all the claimants are answered by the same sweep
+    # Consecutive blocks are relaxed together as long as no transfer of the chunk feeds another transfer
+    # of the same or a later block in the chunk; blocks with such chains are relaxed until nothing changes
+    # Returns the hops and the arrival blocks of the claimants (-1 if no exchange is reachable)
+    unreached = np.iinfo(np.int64).max
+    hops = np.full(len(is_exchange), unreached, dtype=np.int64)
+    arrivals = np.full(len(is_exchange), unreached, dtype=np.int64)
+    # Self transfers never shorten a path
+    order = np.flatnonzero(sources != targets)
+    order = order[np.argsort(block_numbers[order], kind='stable')[::-1]]
+    blocks = block_numbers[order]
+    u_all, v_all = sources[order].astype(np.int64), targets[order].astype(np.int64)
+    is_start = np.r_[True, blocks[1:] != blocks[:-1]][:len(blocks)]
+    block_ids = np.cumsum(is_start) - 1
+    block_starts = np.flatnonzero(is_start)
+    block_ends = np.r_[block_starts[1:], len(blocks)]
+
+    claimants = np.asarray(claimants, dtype=np.int64)
+    claim_blocks = np.asarray(claim_blocks, dtype=np.int64)
+    by_claim = np.argsort(claim_blocks, kind='stable')[::-1]
+    claimant_of_node = np.full(len(is_exchange), -1, dtype=np.int64)
+    claimant_of_node[claimants] = np.arange(len(claimants))
+    claimant_hops = np.full(len(claimants), unreached, dtype=np.int64)
+    claimant_arrivals = np.full(len(claimants), unreached, dtype=np.int64)
+    next_claimant = 0
+
+    def record(block):
+        # Claimants whose claim block is at or after block, before the sweep processes earlier blocks
+        nonlocal next_claimant
+        end = next_claimant + \
+            np.searchsorted(-claim_blocks[by_claim[next_claimant:]], -block, side='right')
+        indexes = by_claim[next_claimant:end]
+        claimant_hops[indexes] = hops[claimants[indexes]]
+        claimant_arrivals[indexes] = arrivals[claimants[indexes]]
+        next_claimant = end
+
+    def relax(u, v, block):
+        # Candidate hops and arrival blocks of the transfers u -> v from the current state
+        candidate_hops = np.where(
+            is_exchange[v], 1, np.minimum(hops[v], unreached - 1) + 1)
+        candidate_arrivals = np.where(is_exchange[v], block, arrivals[v])
+        return candidate_hops, candidate_arrivals
+
+    position, chunk_size = 0, 1024
+    while position < len(blocks):
+        end = block_ends[block_ids[min(position + chunk_size, len(blocks)) - 1]]
+        u, v = u_all[position:end], v_all[position:end]
+        # First position of every node as a sender in the chunk: a transfer depends on the chunk when its
+        # receiver sends before the end of its own block
+        senders, first_positions = np.unique(u, return_index=True)
+        indexes = np.minimum(np.searchsorted(senders, v), len(senders) - 1)
+        dependent = (senders[indexes] == v) & (first_positions[indexes] <
+                                                block_ends[block_ids[position:end]] - position)
+        if dependent.any():
+            chunk_size = max(chunk_size // 2, 1)
+            cut = block_starts[block_ids[position + np.argmax(dependent)]]
+            if cut == position:
+                # Chains within the first block: relax it until nothing changes
+                end = block_ends[block_ids[position]]
+                block = blocks[position]
+                record(block + 1)
+                u, v = u_all[position:end], v_all[position:end]
+                while True:
+                    candidate_hops, candidate_arrivals = relax(u, v, block)
+                    before_hops, before_arrivals = hops[u], arrivals[u]
+                    np.minimum.at(hops, u, candidate_hops)
+                    np.minimum.at(arrivals, u, candidate_arrivals)
+                    if (hops[u] == before_hops).all() and (arrivals[u] == before_arrivals).all():
+                        break
+                position = end
+                continue
+            end = cut
+            u, v = u_all[position:end], v_all[position:end]
+        else:
+            chunk_size = min(chunk_size * 2, 2**20)
+        edge_blocks = blocks[position:end]
+        candidate_hops, candidate_arrivals = relax(u, v, edge_blocks)
+        # Claimants whose claim block falls inside the chunk only see its transfers at or after the claim
+        record(edge_blocks[-1] + 1)
+        claimant = claimant_of_node[u]
+        inside = claimant >= 0
+        inside[inside] = (claim_blocks[claimant[inside]] > edge_blocks[-1]) & \
+            (claim_blocks[claimant[inside]] <= edge_blocks[0]) & \
+            (edge_blocks[inside] >= claim_blocks[claimant[inside]])
+        np.minimum.at(claimant_hops, claimant[inside], candidate_hops[inside])
+        np.minimum.at(claimant_arrivals,
+                      claimant[inside], candidate_arrivals[inside])
+        np.minimum.at(hops, u, candidate_hops)
+        np.minimum.at(arrivals, u, candidate_arrivals)
+        position = end
+    record(np.iinfo(np.int64).min + 1)
+    reached = claimant_hops < unreached
+    return np.where(reached, claimant_hops, -1), np.where(reached, claimant_arrivals, -1)
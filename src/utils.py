@@ -1,17 +1,729 @@
 import web3
+import functools
+import glob
+import gzip
+import hashlib
 import os
 import json
+import pickle
+import shutil
+import numpy as np
 import polars as pl
+import pyarrow.parquet as pq
 from tqdm import tqdm
+from eth_utils import abi_to_signature
 from ethereum import to_checksum_address
 
 
+class BlockTimestampIndex:
+    # Dense block number -> timestamp (epoch seconds) array stored as an uncompressed .npy file
+    # and opened via mmap, so timestamp enrichment is a vectorised gather instead of a join
+    # Blocks missing from the dataset hold -1
+
+    def __init__(self, file_path):
+        self.timestamps = np.load(file_path, mmap_mode='r')
+        self.max_timestamps = None
+
+    @staticmethod
+    def build(blocks_path, file_path):
+        # Build the index once from the blocks files
+        blocks = (
+            pl.scan_parquet(blocks_path)
+            .select(pl.col('number'), pl.col('timestamp'))
+            .unique('number')
+        ).collect(streaming=True)
+        timestamps = np.lib.format.open_memmap(
+            file_path + '.tmp', mode='w+', dtype=np.int64, shape=(blocks['number'].max() + 1,))
+        timestamps[:] = -1
+        timestamps[blocks['number'].to_numpy()] = blocks['timestamp'].to_numpy()
+        timestamps.flush()
+        del timestamps
+        os.replace(file_path + '.tmp', file_path)
+        return BlockTimestampIndex(file_path)
+
+    def get_epochs(self, block_numbers):
+        block_numbers = np.asarray(block_numbers, dtype=np.int64)
+        epochs = np.full(len(block_numbers), -1, dtype=np.int64)
+        valid = (block_numbers >= 0) & (block_numbers < len(self.timestamps))
+        epochs[valid] = self.timestamps[block_numbers[valid]]
+        return epochs
+
+    def get_timestamps(self, block_numbers):
+        # Datetime series with the timestamp of every block number (null for unknown blocks)
+        epochs = self.get_epochs(block_numbers)
+        timestamps = pl.Series('timestamp', epochs)
+        timestamps = timestamps.scatter(np.flatnonzero(epochs < 0), None)
+        return pl.from_epoch(timestamps)
+
+    def get_block_numbers(self, epochs):
+        # First block mined at or after each timestamp (epoch seconds), found by binary search
+        if self.max_timestamps is None:
+            self.max_timestamps = np.maximum.accumulate(self.timestamps)
+        return np.searchsorted(self.max_timestamps, np.asarray(epochs, dtype=np.int64), side='left')
+
+
+class TopicAddressIndex:
+    # Inverted index from the addresses found in topics_1..3 of the logs to the (file, row group)
+    # locations holding them, so that a lookup reads only the matching row groups of the logs
+    # The index is a parquet file sorted by address (row group statistics prune the lookups) and a
+    # list of the indexed files with their size and mtime, used to reindex only new or changed files
+
+    def __init__(self, logs_path, index_dir, binary_addresses=False):
+        self.logs_path = logs_path
+        self.index_dir = index_dir
+        self.binary_addresses = binary_addresses
+        self.index_path = os.path.join(index_dir, 'index.parquet')
+        self.files_path = os.path.join(index_dir, 'files.parquet')
+
+    def get_files(self):
+        paths = sorted(glob.glob(self.logs_path))
+        return pl.DataFrame({'file': paths,
+                             'size': [os.path.getsize(path) for path in paths],
+                             'mtime': [os.path.getmtime(path) for path in paths]},
+                            schema={'file': pl.String, 'size': pl.Int64, 'mtime': pl.Float64})
+
+    def get_topic_addresses(self, column):
+        # Last 20 bytes of the 32-byte topics (topics holding an address are left-padded with zeros)
+        if self.binary_addresses:
+            return (pl.when(pl.col(column).bin.size() == 32)
+                    .then(pl.col(column).bin.encode('hex').str.slice(24).str.decode('hex')))
+        return (pl.when(pl.col(column).str.len_bytes() == 66)
+                .then(pl.col(column).str.slice(-40).str.decode('hex')))
+
+    def index_file(self, path):
+        parquet_file = pq.ParquetFile(path)
+        columns = [column for column in ['topics_1', 'topics_2', 'topics_3']
+                   if column in parquet_file.schema_arrow.names]
+        row_groups = list()
+        for row_group in range(parquet_file.num_row_groups):
+            topics = pl.from_arrow(
+                parquet_file.read_row_group(row_group, columns=columns))
+            row_groups.append(
+                topics.select(pl.concat_list(
+                    [self.get_topic_addresses(column) for column in columns]).alias('address'))
+                .explode('address')
+                .drop_nulls()
+                .unique()
+                .with_columns(pl.lit(path).alias('file'), pl.lit(row_group, dtype=pl.UInt32).alias('row_group')))
+        return row_groups
+
+    def update(self, rebuild=False):
+        # Index the logs files that are new or changed since the last update
+        files = self.get_files()
+        indexed_files = files.clear()
+        if not rebuild and os.path.exists(self.index_path):
+            indexed_files = pl.read_parquet(self.files_path).join(
+                files, on=['file', 'size', 'mtime'], how='semi')
+        pending_files = files.join(indexed_files, on='file', how='anti')
+        if os.path.exists(self.index_path) and pending_files.height == 0 and indexed_files.height == pl.read_parquet(self.files_path).height:
+            return self
+        index = list()
+        if indexed_files.height > 0:
+            index.append(pl.read_parquet(self.index_path).filter(
+                pl.col('file').is_in(indexed_files['file'])))
+        for path in tqdm(pending_files['file'], desc='Indexing topic addresses'):
+            index += self.index_file(path)
+        os.makedirs(self.index_dir, exist_ok=True)
+        index = pl.concat(index, how='vertical_relaxed') if index else pl.DataFrame(
+            schema={'address': pl.Binary, 'file': pl.String, 'row_group': pl.UInt32})
+        index.sort(['address', 'file', 'row_group']).write_parquet(
+            self.index_path + '.tmp', compression='zstd', statistics=True, row_group_size=100_000)
+        os.replace(self.index_path + '.tmp', self.index_path)
+        files.write_parquet(self.files_path)
+        return self
+
+    def get_locations(self, address):
+        # {file: [row groups]} of the logs mentioning the address in an indexed topic
+        locations = (
+            pl.scan_parquet(self.index_path)
+            .filter(pl.col('address') == bytes.fromhex(address[2:]))
+            .group_by('file')
+            .agg(pl.col('row_group').sort())
+            .sort('file')
+        ).collect()
+        return dict(zip(locations['file'], locations['row_group'].to_list()))
+
+    def get_logs(self, address, columns=None):
+        # Rows of the matching row groups only; they still have to be filtered by the caller
+        # Only 32-byte topics are indexed, so the filter must also require 32-byte topics
+        logs = [pl.from_arrow(pq.ParquetFile(path).read_row_groups(row_groups, columns=columns))
+                for path, row_groups in self.get_locations(address).items()]
+        if logs:
+            return pl.concat(logs, how='vertical_relaxed')
+        # Empty frame with the schema of the logs (without any columns if there are no logs files)
+        paths = sorted(glob.glob(self.logs_path))
+        schema = pl.read_parquet_schema(paths[0]) if paths else dict()
+        if columns is not None:
+            schema = {column: dtype for column, dtype in schema.items() if column in columns}
+        return pl.DataFrame(schema=schema)
+
+
+class BalanceIndex:
+    # Point-in-time token balances built from the history of Utils.compute_account_balances
+    # The deltas are stored sorted by address then transfer order, with a snapshot of the balance every
+    # snapshot_interval deltas of an address. A lookup binary searches the last delta of the address at
+    # or before the block and adds the (at most snapshot_interval) deltas since the previous snapshot
+    # Int128 values are stored as decimal strings since parquet cannot store them yet
+
+    def __init__(self, file_path):
+        df = pl.read_parquet(file_path)
+        is_start = df['address'].ne_missing(
+            df['address'].shift(1)).to_numpy()
+        is_start[:1] = True
+        starts = np.flatnonzero(is_start)
+        self.address_list = df['address'].gather(starts).to_numpy()
+        self.address_ids = pl.DataFrame({'address': df['address'].gather(starts),
+                                         'id': np.arange(len(starts))})
+        self.offsets = np.r_[starts, len(df)]
+        self.block_numbers = df['block_number'].to_numpy()
+        # (address id, block number) keys sorted as the deltas, for vectorised binary searches
+        self.max_block = int(self.block_numbers.max()) + 1 if len(df) else 1
+        self.keys = (np.cumsum(is_start) - 1) * \
+            self.max_block + self.block_numbers
+        self.deltas = df['delta'].cast(pl.Int128)
+        self.snapshot_rows = np.flatnonzero(
+            df['snapshot'].is_not_null().to_numpy())
+        self.snapshots = df['snapshot'].drop_nulls().cast(pl.Int128)
+        self.snapshot_interval = int(np.diff(
+            np.r_[self.snapshot_rows, len(df)]).max()) if len(df) else 0
+
+    @staticmethod
+    def build(history, file_path, snapshot_interval=64):
+        # history: address, block_number, delta and balance_before columns in transfer order
+        history = (history
+                   .with_row_index('order')
+                   .sort(['address', 'order']))
+        is_start = history['address'].ne_missing(
+            history['address'].shift(1)).to_numpy()
+        is_start[:1] = True
+        starts = np.flatnonzero(is_start)
+        rows = np.arange(len(history))
+        is_snapshot = (rows - starts[np.cumsum(is_start) - 1]
+                       ) % snapshot_interval == 0
+        (history
+         .select([pl.col('address'), pl.col('block_number'), pl.col('delta').cast(pl.String),
+                  pl.when(pl.lit(pl.Series(is_snapshot))).then(pl.col('balance_before').cast(pl.String))
+                  .alias('snapshot')])
+         .write_parquet(file_path + '.tmp'))
+        os.replace(file_path + '.tmp', file_path)
+        return BalanceIndex(file_path)
+
+    def get_balance(self, address, block_number):
+        # Balance of the address at the end of the block
+        index = np.searchsorted(self.address_list, address)
+        if index == len(self.address_list) or self.address_list[index] != address:
+            return 0
+        start, end = self.offsets[index], self.offsets[index + 1]
+        row = start + \
+            np.searchsorted(
+                self.block_numbers[start:end], block_number, side='right') - 1
+        if row < start:
+            return 0
+        snapshot = np.searchsorted(self.snapshot_rows, row, side='right') - 1
+        return self.snapshots[int(snapshot)] + sum(self.deltas[int(self.snapshot_rows[snapshot]):int(row) + 1].to_list())
+
+    def get_balances(self, addresses, block_numbers):
+        # Balances of every (address, block) pair at the end of the block as an Int128 series
+        queries = pl.DataFrame({'address': pl.Series(addresses, dtype=pl.String),
+                                'block_number': pl.Series(block_numbers, dtype=pl.Int64)})
+        if len(self.deltas) == 0:
+            return pl.Series('balance', np.zeros(len(queries), dtype=np.int64)).cast(pl.Int128)
+        ids = queries.join(self.address_ids, on='address', how='left', maintain_order='left')[
+            'id'].fill_null(-1).to_numpy()
+        block_numbers = queries['block_number'].to_numpy()
+        rows = np.searchsorted(self.keys, ids * self.max_block + np.clip(block_numbers, 0, self.max_block - 1),
+                               side='right') - 1
+        found = (ids >= 0) & (block_numbers >= 0) & (
+            rows >= self.offsets[np.maximum(ids, 0)])
+        rows = np.where(found, rows, 0)
+        snapshots = np.searchsorted(self.snapshot_rows, rows, side='right') - 1
+        first_rows = self.snapshot_rows[np.maximum(snapshots, 0)]
+        balances = self.snapshots.gather(np.maximum(snapshots, 0))
+        for offset in range(self.snapshot_interval):
+            in_range = first_rows + offset <= rows
+            if not in_range.any():
+                break
+            deltas = pl.DataFrame({'delta': self.deltas.gather(np.minimum(first_rows + offset, len(self.deltas) - 1)),
+                                   'in_range': in_range})
+            balances = balances + deltas.select(
+                pl.when(pl.col('in_range')).then(pl.col('delta')).otherwise(pl.lit(0, dtype=pl.Int128)))['delta']
+        return (pl.DataFrame({'balance': balances, 'found': found})
+                .select(pl.when(pl.col('found')).then(pl.col('balance')).otherwise(pl.lit(0, dtype=pl.Int128)))
+                .to_series().alias('balance'))
+
+
+class ProtocolTables:
+    # Incremental refresh of the <name>_transfer / <name>_claim tables of notebook 02
+    # A table is a directory <name>_transfer.parquet/ of parts, one per refresh (pl.read_parquet and
+    # pl.scan_parquet read the directory as they read the single file), and tables_state.json records the
+    # high-water mark of every table: the last block included. A refresh only decodes the events above the
+    # mark, joins the timestamps of those blocks and appends one part, then updates in place the daily
+    # aggregates (<table>_daily.parquet) and, for transfers, the exact balances (<name>_balances.parquet)
+    # The daily aggregates and the balances keep their own high-water mark, so an interrupted refresh
+    # neither counts a row twice nor loses it
+    # A table without state is rebuilt from the given events, so the first refresh takes the full event list
+
+    def __init__(self, data_dir, blocks_path=None):
+        self.data_dir = data_dir
+        self.blocks_path = blocks_path or os.path.join(
+            data_dir, 'blocks.parquet.gz')
+        self.state_path = os.path.join(data_dir, 'tables_state.json')
+        self.state = dict()
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as f:
+                self.state = json.load(f)
+
+    def get_path(self, table, suffix='.parquet'):
+        return os.path.join(self.data_dir, table + suffix)
+
+    def get_high_water_mark(self, table):
+        return self.state.get(table, {}).get('block', -1)
+
+    def save_state(self):
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def reset(self, table):
+        # Drop the table and its derived files (also the single-file tables written by notebook 02)
+        for path in [self.get_path(table), self.get_path(table, '_daily.parquet')]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        self.state.pop(table, None)
+        self.state.pop(table + '_daily', None)
+
+    def get_new_rows(self, table, df, to_block=None):
+        # Rows above the high-water mark (and up to to_block) with the timestamps of their blocks
+        # Returns the rows and the block up to which the table can be appended: rows from the first block
+        # missing from the blocks file onwards are left for a later refresh
+        if table not in self.state:
+            self.reset(table)
+        first_block = self.get_high_water_mark(table) + 1
+        df = df.filter(pl.col('blockNumber') >= first_block)
+        if to_block is not None:
+            df = df.filter(pl.col('blockNumber') <= to_block)
+        # Without new rows the (empty) join still gives the parts the timestamp column
+        blocks = pl.scan_parquet(self.blocks_path).select(['number', 'timestamp'])
+        if df.height:
+            blocks = (blocks
+                      .filter(pl.col('number').is_between(first_block, df['blockNumber'].max()))
+                      .unique('number'))
+        else:
+            blocks = blocks.head(0)
+        df = (df
+              .join(blocks.collect(), left_on='blockNumber', right_on='number', how='left')
+              .sort(['blockNumber', 'transactionIndex', 'logIndex']))
+        missing_block = df.filter(pl.col('timestamp').is_null())['blockNumber'].min()
+        if missing_block is not None:
+            print("{}: block {} is missing from {}, rows are kept up to block {}".format(
+                table, missing_block, self.blocks_path, missing_block - 1))
+            df = df.filter(pl.col('blockNumber') < missing_block)
+            to_block = missing_block - 1
+        return df, to_block
+
+    def append(self, table, df, to_block=None):
+        # Append the new rows as one part named by its block range, then move the high-water mark
+        first_block = self.get_high_water_mark(table) + 1
+        last_block = max(first_block - 1, to_block if to_block is not None else -1,
+                         df['blockNumber'].max() if df.height else -1)
+        path = self.get_path(table)
+        os.makedirs(path, exist_ok=True)
+        # Parts above the mark were left by an interrupted refresh
+        for part in glob.glob(os.path.join(path, 'part-*.parquet')):
+            if int(os.path.basename(part).split('-')[1]) >= first_block:
+                os.remove(part)
+        if df.height or not glob.glob(os.path.join(path, 'part-*.parquet')):
+            # Zero-padded block ranges keep the parts (and so the rows) in block order
+            part = os.path.join(
+                path, 'part-{:012d}-{:012d}.parquet'.format(first_block, last_block))
+            df.write_parquet(part + '.tmp', compression="gzip")
+            os.replace(part + '.tmp', part)
+        self.state[table] = {'block': int(last_block),
+                             'rows': self.state.get(table, {}).get('rows', 0) + df.height}
+        self.save_state()
+        print("{}: {} new rows up to block {}".format(
+            table, df.height, last_block))
+
+    def update_daily(self, table, columns=None):
+        # Daily number of events and amount, and number of events matching every expression of columns
+        # ({name: boolean expression}, e.g. mints), of the rows appended since the last daily update
+        # Distinct counts (e.g. senders) are not additive, so only counts and sums are kept. The days of
+        # those rows are recomputed from the parts, so running the update again after a crash is harmless
+        columns = columns or dict()
+        daily_mark = self.get_high_water_mark(table + '_daily')
+        last_block = self.get_high_water_mark(table)
+        if last_block <= daily_mark:
+            return
+        path = self.get_path(table, '_daily.parquet')
+        rows = pl.scan_parquet(os.path.join(self.get_path(table), 'part-*.parquet'))
+        if rows.collect_schema()['timestamp'].is_integer():
+            rows = rows.with_columns(pl.from_epoch(pl.col('timestamp')))
+        rows = rows.with_columns(pl.col('timestamp').dt.date().alias('date'))
+        dates = rows.filter(pl.col('blockNumber') > daily_mark).select('date').unique().collect()
+        if dates.height == 0:
+            self.state[table + '_daily'] = {'block': last_block}
+            self.save_state()
+            return
+        daily = (rows
+                 .filter(pl.col('date') >= dates['date'].min())
+                 .join(dates.lazy(), on='date', how='semi')
+                 .group_by('date')
+                 .agg(pl.len().cast(pl.Int64).alias('n_events'), pl.col('amount').sum().cast(pl.Float64),
+                      *[expression.sum().cast(pl.Int64).alias('n_' + name) for name, expression in columns.items()])
+                 ).collect()
+        if os.path.exists(path):
+            daily = pl.concat([pl.read_parquet(path).join(dates, on='date', how='anti'), daily],
+                              how='vertical_relaxed')
+        daily.sort('date').write_parquet(path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self.state[table + '_daily'] = {'block': last_block}
+        self.save_state()
+
+    def update_balances(self, name, transfers, sender='from', receiver='to'):
+        # Exact balances (Int128 token units stored as decimal strings) updated with the new transfers:
+        # the history of the new legs starts from the current balance of every address
+        # The balances keep their own high-water mark since they are written before the table part
+        first_block = self.get_high_water_mark(name + '_balances') + 1
+        transfers = transfers.filter(pl.col('blockNumber') >= first_block)
+        if transfers.height == 0:
+            return
+        history, accounts = Utils.compute_account_balances(
+            transfers, sender=sender, receiver=receiver, amount='amount')
+        path = self.get_path(name, '_balances.parquet')
+        history_path = self.get_path(name, '_balance_history.parquet')
+        if os.path.exists(path):
+            current = (pl.read_parquet(path)
+                       .select(pl.col('address'), pl.col('current').cast(pl.Int128).alias('previous'),
+                               pl.col('n_sender').alias('previous_sender'),
+                               pl.col('n_receiver').alias('previous_receiver')))
+            offsets = history.join(current, on='address', how='left', maintain_order='left')[
+                'previous'].fill_null(0)
+            history = history.with_columns(history['balance_before'] + offsets,
+                                           history['balance_after'] + offsets)
+            accounts = accounts.join(current, on='address', how='full', coalesce=True).with_columns(
+                pl.col('current').fill_null(pl.lit(0, dtype=pl.Int128)),
+                pl.col('previous').fill_null(pl.lit(0, dtype=pl.Int128)))
+            accounts = (accounts
+                        .with_columns(accounts['current'] + accounts['previous'],
+                                      pl.col('n_sender').fill_null(0) + pl.col('previous_sender').fill_null(0),
+                                      pl.col('n_receiver').fill_null(0) + pl.col('previous_receiver').fill_null(0))
+                        .select(['address', 'current', 'n_sender', 'n_receiver'])
+                        .sort('address'))
+        os.makedirs(history_path, exist_ok=True)
+        part = os.path.join(history_path, 'part-{:012d}.parquet'.format(first_block))
+        (history
+         .with_columns([pl.col(column).cast(pl.String) for column in ['delta', 'balance_before', 'balance_after']])
+         .write_parquet(part + '.tmp'))
+        os.replace(part + '.tmp', part)
+        accounts.with_columns(pl.col('current').cast(pl.String)).write_parquet(path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self.state[name + '_balances'] = {'block': int(history['block_number'].max())}
+        self.save_state()
+
+    def refresh_transfers(self, name, events, decimals, to_block=None, amount_column="amount",
+                          sender="from", receiver="to", claiming_addresses=None):
+        # events: Transfer events crawled since the last refresh (the full list on the first refresh)
+        # claiming_addresses also refreshes <name>_claim as the transfers sent by the airdrop contracts
+        table = name + '_transfer'
+        if table not in self.state:
+            for path in [self.get_path(name, '_balances.parquet'), self.get_path(name, '_balance_history.parquet')]:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif os.path.exists(path):
+                    os.remove(path)
+            self.state.pop(name + '_balances', None)
+        transfers, to_block = self.get_new_rows(table, Utils.transfer_to_dataframe(
+            events, amount_colum=amount_column, sender=sender, receiver=receiver), to_block=to_block)
+        if transfers.height:
+            self.update_balances(name, transfers)
+        transfers = transfers.with_columns(
+            pl.col('amount').cast(pl.Float64).truediv(10**decimals).alias('amount'))
+        self.append(table, transfers, to_block=to_block)
+        self.update_daily(table, columns={'mint': pl.col('from') == '0x' + '0' * 40})
+        if claiming_addresses:
+            self.refresh_claims(name, transfers.filter(pl.col('from').is_in(claiming_addresses)),
+                                decimals=None, to_block=self.get_high_water_mark(table))
+        return transfers
+
+    def refresh_claims(self, name, events, decimals, to_block=None, amount_column="amount",
+                       account_column="account"):
+        # events: claim events crawled since the last refresh, or a dataframe of claims already converted
+        # (decimals=None when its amounts are already divided by the decimals)
+        table = name + '_claim'
+        claims = events if isinstance(events, pl.DataFrame) else Utils.claim_to_dataframe(
+            events, amount_colum=amount_column, account_column=account_column)
+        if 'timestamp' in claims.columns:
+            claims = claims.drop('timestamp')
+        claims, to_block = self.get_new_rows(table, claims, to_block=to_block)
+        if decimals is not None:
+            claims = claims.with_columns(
+                pl.col('amount').cast(pl.Float64).truediv(10**decimals).alias('amount'))
+        self.append(table, claims, to_block=to_block)
+        self.update_daily(table)
+        return claims
+
+
+class EventRegistry:
+    # topic_0 -> event name and text signature, with the keccak of every signature computed once when it
+    # is added. Populated from events_dict, lists of text signatures (e.g. 4byte.directory exports) and
+    # contract ABIs (e.g. the ABICache of ethereum.py); label() attaches the names and signatures to a
+    # whole topics_0 column (hex strings or binary) with a single join
+
+    def __init__(self, events=None):
+        self.events = dict()
+        self.frame = None
+        if events:
+            for topic, event in events.items():
+                self.add(topic, event['name'], event['signature'])
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_topic(signature):
+        return web3.Web3.to_hex(web3.Web3.keccak(text=signature))
+
+    def add(self, topic, name, signature):
+        # Known signatures are not overwritten by 'Unknown' placeholders
+        topic = topic.lower()
+        if signature == 'Unknown' and topic in self.events:
+            return
+        self.events[topic] = {'name': name, 'signature': signature}
+        self.frame = None
+
+    def add_signature(self, signature):
+        signature = signature.replace(' ', '')
+        self.add(self.get_topic(signature),
+                 signature.split('(')[0], signature)
+
+    def add_signatures(self, signatures):
+        for signature in signatures:
+            self.add_signature(signature)
+
+    def add_abi(self, abi):
+        for entry in abi:
+            if entry.get('type') == 'event' and not entry.get('anonymous', False):
+                self.add_signature(abi_to_signature(entry))
+
+    def add_abi_cache(self, abi_cache):
+        # Every distinct ABI of an ethereum.ABICache (or of its cache directory)
+        cache_dir = getattr(abi_cache, 'cache_dir', abi_cache)
+        for path in glob.glob(os.path.join(cache_dir, 'abis', '*.json')):
+            with open(path) as f:
+                self.add_abi(json.load(f))
+
+    def get_name(self, topic):
+        return self.events.get(topic.lower(), {}).get('name', 'Unknown')
+
+    def get_signature(self, topic):
+        return self.events.get(topic.lower(), {}).get('signature', 'Unknown')
+
+    def check(self, signature, topic):
+        return self.get_topic(signature) == topic.lower()
+
+    def to_dataframe(self):
+        if self.frame is None:
+            self.frame = pl.DataFrame({
+                'topics_0': list(self.events),
+                'event_name': [event['name'] for event in self.events.values()],
+                'event_signature': [event['signature'] for event in self.events.values()],
+            }, schema={'topics_0': pl.String, 'event_name': pl.String, 'event_signature': pl.String})
+        return self.frame
+
+    def label(self, df, column='topics_0'):
+        # Left join of the registry on the topics column ('Unknown' for unregistered topics)
+        schema = df.collect_schema() if isinstance(df, pl.LazyFrame) else df.schema
+        events = self.to_dataframe().rename({'topics_0': column})
+        if schema[column] == pl.Binary:
+            events = events.with_columns(
+                pl.col(column).str.slice(2).str.decode('hex'))
+        else:
+            df = df.with_columns(pl.col(column).str.to_lowercase())
+        if isinstance(df, pl.LazyFrame):
+            events = events.lazy()
+        return (df
+                .join(events, on=column, how='left', maintain_order='left')
+                .with_columns(pl.col('event_name').fill_null('Unknown'),
+                              pl.col('event_signature').fill_null('Unknown')))
+
+
+# Version of the cached query results: bump it when the output of a cached query changes
+# (e.g. new columns), so the entries of the previous version are not used anymore
+QUERY_CACHE_VERSION = 2
+
+
+class QueryCache:
+    # Results of the Utils queries stored on disk (parquet for dataframes, gzip pickle otherwise) and
+    # keyed by the method name, its arguments and the fingerprint (path, size, mtime) of the dataset files
+    # it reads, so a result is recomputed only when the data changes
+    # Least recently used results are evicted when the cache exceeds max_bytes
+
+    def __init__(self, cache_dir, max_bytes=10 * 2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_fingerprint(paths):
+        fingerprint = list()
+        for path in paths:
+            for file_path in sorted(glob.glob(path)):
+                stat = os.stat(file_path)
+                fingerprint.append((file_path, stat.st_size, stat.st_mtime_ns))
+        return fingerprint
+
+    @staticmethod
+    def encode_argument(value):
+        # json.dumps fallback for the arguments that are not JSON types
+        # Arrays and series are hashed on their content (their repr is truncated)
+        if isinstance(value, (pl.DataFrame, pl.Series)):
+            hashes = value.hash_rows(seed=0) if isinstance(
+                value, pl.DataFrame) else value.hash(seed=0)
+            return [type(value).__name__, value.shape, hashlib.sha256(hashes.to_numpy().tobytes()).hexdigest()]
+        if isinstance(value, np.ndarray):
+            # Object arrays (e.g. of address strings) hold pointers, so their values are hashed instead
+            content = repr(value.tolist()).encode() if value.dtype == object else np.ascontiguousarray(
+                value).tobytes()
+            return ['ndarray', str(value.dtype), value.shape, hashlib.sha256(content).hexdigest()]
+        if type(value).__module__.startswith('pandas'):
+            import pandas as pd
+            if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+                hashes = pd.util.hash_pandas_object(value, index=not isinstance(value, pd.Index))
+                return [type(value).__name__, value.shape, hashlib.sha256(hashes.to_numpy().tobytes()).hexdigest()]
+        if isinstance(value, (set, frozenset)):
+            return sorted(value)
+        return repr(value)
+
+    def get_key(self, method, args, kwargs, paths, options=None):
+        # options: settings of the Utils instance changing the output format of the queries
+        key = json.dumps([method, args, kwargs, options, QueryCache.get_fingerprint(paths), pl.__version__,
+                          QUERY_CACHE_VERSION],
+                         sort_keys=True, default=QueryCache.encode_argument)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get_path(self, key, result=None):
+        if result is None:
+            for extension in ['.parquet', '.pkl.gz']:
+                if os.path.exists(os.path.join(self.cache_dir, key + extension)):
+                    return os.path.join(self.cache_dir, key + extension)
+            return None
+        extension = '.parquet' if isinstance(result, pl.DataFrame) else '.pkl.gz'
+        return os.path.join(self.cache_dir, key + extension)
+
+    def get(self, key):
+        # (True, result) on a hit, (False, None) on a miss
+        file_path = self.get_path(key)
+        if file_path is None:
+            return False, None
+        # The modification time tracks the last use for the LRU eviction
+        os.utime(file_path)
+        if file_path.endswith('.parquet'):
+            return True, pl.read_parquet(file_path)
+        with gzip.open(file_path, 'rb') as f:
+            return True, pickle.load(f)
+
+    def put(self, key, result):
+        file_path = self.get_path(key, result)
+        try:
+            if isinstance(result, pl.DataFrame):
+                result.write_parquet(file_path + '.tmp')
+            else:
+                with gzip.open(file_path + '.tmp', 'wb') as f:
+                    pickle.dump(result, f)
+        except Exception as e:
+            # e.g. Int128 columns that parquet cannot store yet: the result is just not cached
+            print("Could not cache {}: {}".format(key, e))
+            if os.path.exists(file_path + '.tmp'):
+                os.remove(file_path + '.tmp')
+            return
+        os.replace(file_path + '.tmp', file_path)
+        self.evict()
+
+    def evict(self):
+        entries = [os.path.join(self.cache_dir, filename)
+                   for filename in os.listdir(self.cache_dir) if not filename.endswith('.tmp')]
+        entries = sorted([(os.path.getmtime(entry), os.path.getsize(entry), entry) for entry in entries],
+                         reverse=True)
+        total_bytes = 0
+        for _, size, entry in entries:
+            total_bytes += size
+            if total_bytes > self.max_bytes:
+                os.remove(entry)
+
+    def clear(self):
+        for filename in os.listdir(self.cache_dir):
+            os.remove(os.path.join(self.cache_dir, filename))
+
+
+def cached_query(*files, label=None):
+    # Decorator of the Utils queries reading the dataset files (all of them by default), transparent
+    # unless Utils was created with a cache_dir
+    # label: topics column labelled by event_registry after the cache lookup (also every dataframe of a
+    # {protocol: dataframe} result), so the signatures added to the registry later show on cache hits
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if self.query_cache is None:
+                result = func(self, *args, **kwargs)
+            else:
+                key = self.query_cache.get_key(func.__name__, args, kwargs,
+                                               [self.data_path[file] for file in files or DATA_FILES],
+                                               options={'binary_addresses': self.binary_addresses,
+                                                        'lowercase_addresses': self.lowercase_addresses,
+                                                        'use_timestamp_index': self.timestamp_index is not None})
+                found, result = self.query_cache.get(key)
+                if not found:
+                    result = func(self, *args, **kwargs)
+                    self.query_cache.put(key, result)
+            if label is None:
+                return result
+            if isinstance(result, dict):
+                return {name: event_registry.label(df, column=label) for name, df in result.items()}
+            return event_registry.label(result, column=label)
+        return wrapper
+    return decorator
+
+
+DATA_FILES = ('blocks', 'transactions', 'tx_receipts', 'logs')
+
+TRANSFER_TOPIC = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+
+# Address, hash and topic columns stored as raw bytes by Utils.normalize_dataset
+BINARY_COLUMNS = ['hash', 'parentHash', 'blockHash', 'transactionHash', 'miner', 'address',
+                  'from', 'to', 'contractAddress', 'topics_0', 'topics_1', 'topics_2', 'topics_3']
+
+# Clustering keys of Utils.compact_dataset, following the filters of the Utils queries
+COMPACTION_KEYS = {
+    'blocks': ['number'],
+    'transactions': ['to', 'from', 'blockNumber', 'transactionIndex'],
+    'tx_receipts': ['from', 'blockNumber', 'transactionIndex'],
+    'logs': ['address', 'topics_0', 'blockNumber', 'logIndex'],
+}
+
+
 class Utils:
 
-    def __init__(self, zkSync_data_dir="", data_dir='../data/'):
+    def __init__(self, zkSync_data_dir="", data_dir='../data/', use_timestamp_index=False, binary_addresses=False,
+                 use_topic_index=False, lowercase_addresses=False, cache_dir=None, cache_max_bytes=10 * 2**30):
         # Existing dataset
+        # binary_addresses=True for datasets normalised with normalize_dataset: queries then compare raw bytes
+        # instead of lowercasing every address of the scans, and hex-encode only the selected rows
+        # lowercase_addresses=True for datasets compacted with lowercase hex addresses: the columns are compared
+        # as stored, so predicate pushdown can skip row groups with the parquet statistics
+        # cache_dir enables the QueryCache of the query results, bounded to cache_max_bytes on disk
         self.data_dir = data_dir
+        self.binary_addresses = binary_addresses
+        self.lowercase_addresses = lowercase_addresses
         self.data_path = self.create_data_path(zkSync_data_dir)
+        self.timestamp_index = None
+        if use_timestamp_index:
+            self.timestamp_index = self.load_timestamp_index()
+        self.topic_index = None
+        if use_topic_index:
+            self.topic_index = self.load_topic_index()
+        self.query_cache = None
+        if cache_dir is not None:
+            self.query_cache = QueryCache(cache_dir, max_bytes=cache_max_bytes)
 
     def get_data_path(self):
         return self.data_path
@@ -22,8 +734,179 @@ class Utils:
         data_path['transactions'] = path_dir+'transactions_*.parquet.gz'
         data_path['tx_receipts'] = path_dir+'tx_receipts_*.parquet.gz'
         data_path['logs'] = path_dir+'logs_*.parquet.gz'
+        data_path['block_timestamps'] = path_dir+'block_timestamps.npy'
+        data_path['topic_index'] = path_dir+'topic_address_index/'
         return data_path
 
+    def load_timestamp_index(self, rebuild=False):
+        # Open the block -> timestamp index, building it from the blocks files if needed
+        if rebuild or not os.path.exists(self.data_path['block_timestamps']):
+            return BlockTimestampIndex.build(self.data_path['blocks'], self.data_path['block_timestamps'])
+        return BlockTimestampIndex(self.data_path['block_timestamps'])
+
+    def load_topic_index(self, rebuild=False):
+        # Open the topic address index of the logs, indexing the new or changed logs files
+        return TopicAddressIndex(self.data_path['logs'], self.data_path['topic_index'],
+                                 binary_addresses=self.binary_addresses).update(rebuild=rebuild)
+
+    def add_timestamps(self, df, block_column='blockNumber'):
+        # Attach the block timestamp to a collected dataframe with the timestamp index
+        return df.with_columns(self.timestamp_index.get_timestamps(df[block_column]))
+
+    @staticmethod
+    def normalize_columns(q, binary_addresses=True):
+        # Hex columns of BINARY_COLUMNS as binary (20/32 bytes) or as lowercase hex strings
+        schema = q.collect_schema()
+        columns = [column for column in BINARY_COLUMNS if column in schema]
+        if binary_addresses:
+            return q.with_columns([pl.col(column).str.slice(2).str.decode('hex')
+                                   for column in columns if schema[column] == pl.String])
+        return q.with_columns([pl.col(column).str.to_lowercase() if schema[column] == pl.String
+                               else pl.concat_str(pl.lit('0x'), pl.col(column).bin.encode('hex')).alias(column)
+                               for column in columns])
+
+    def normalize_dataset(self, output_dir, files=('blocks', 'transactions', 'tx_receipts', 'logs')):
+        # Rewrite the dataset files with the hex columns of BINARY_COLUMNS as binary (20/32 bytes)
+        # Load the output with Utils(output_dir, binary_addresses=True)
+        os.makedirs(output_dir, exist_ok=True)
+        for file in files:
+            for path in tqdm(sorted(glob.glob(self.data_path[file])), desc='Normalising {}'.format(file)):
+                Utils.normalize_columns(pl.scan_parquet(path)).sink_parquet(
+                    os.path.join(output_dir, os.path.basename(path)), compression='zstd')
+
+    @staticmethod
+    def get_sort_key(schema, keys):
+        # String whose byte order is the order of sort(keys, nulls_last=True): hex columns (binary or
+        # 0x-prefixed strings) as 64 hex digits padded with '-', integers as 20 zero-padded digits and
+        # nulls as 'z' ('-' < digits < 'z', and the key can be used in file names)
+        columns = list()
+        for key in keys:
+            if schema[key].is_integer():
+                columns.append(pl.col(key).cast(pl.String).str.zfill(20).fill_null('z' * 20))
+                continue
+            column = pl.col(key).bin.encode('hex') if schema[key] == pl.Binary else pl.col(key).str.strip_prefix('0x')
+            columns.append(column.str.pad_end(64, '-').fill_null('z' * 64))
+        return pl.concat_str(columns)
+
+    @staticmethod
+    def write_buckets(df, keys, depth, bucket_dir, suffix):
+        # Split df in buckets by the first depth characters of its sort key (the bucket id), so the buckets
+        # are written to the output in id order. Returns the ids of the written buckets
+        bucket = Utils.get_sort_key(df.schema, keys).str.slice(0, depth).alias('bucket')
+        parts = df.with_columns(bucket).partition_by('bucket', as_dict=True, include_key=False)
+        for (bucket_id,), part in parts.items():
+            part.write_parquet(os.path.join(
+                bucket_dir, '{}_{}.parquet'.format(bucket_id, suffix)))
+        return set(bucket_id for (bucket_id,) in parts)
+
+    def compact_dataset(self, output_dir, files=('transactions', 'tx_receipts', 'logs'), binary_addresses=True,
+                        row_group_size=100_000, max_bucket_bytes=2**30):
+        # Rewrite every dataset as a single zstd file clustered by COMPACTION_KEYS, with bounded row groups
+        # and min/max statistics, so per-contract filters only read the row groups holding the contract
+        # Addresses are normalised to binary (load with binary_addresses=True) or to lowercase hex strings
+        # (load with lowercase_addresses=True)
+        # External sort: the input files are first split in buckets by the leading byte of the first key,
+        # then every bucket is sorted in memory and appended in order to the output file. A bucket larger
+        # than max_bucket_bytes on disk (e.g. a single very active contract) is split again by the next
+        # bytes of the sort key (see get_sort_key), one bucket file at a time, down to rows with identical keys
+        # The output is named <file>_compacted_0.parquet.gz: the suffix is only kept so that the data_path
+        # globs of create_data_path match it, the content is zstd parquet (not gzip)
+        os.makedirs(output_dir, exist_ok=True)
+        for file in files:
+            paths = sorted(glob.glob(self.data_path[file]))
+            if not paths:
+                print('No {} files to compact'.format(file))
+                continue
+            keys = [key for key in COMPACTION_KEYS[file]
+                    if key in pl.read_parquet_schema(paths[0])]
+            bucket_dir = os.path.join(output_dir, file + '_buckets')
+            os.makedirs(bucket_dir, exist_ok=True)
+            bucket_ids = set()
+            for index, path in enumerate(tqdm(paths, desc='Partitioning {}'.format(file))):
+                df = Utils.normalize_columns(pl.scan_parquet(
+                    path), binary_addresses=binary_addresses).collect()
+                bucket_ids |= Utils.write_buckets(df, keys, 2, bucket_dir, index)
+            file_path = os.path.join(output_dir, os.path.basename(
+                self.data_path[file]).replace('*', 'compacted_0'))
+            writer = None
+            # Length of the sort key: a bucket at that depth holds rows with identical keys
+            schema = Utils.normalize_columns(pl.scan_parquet(
+                paths[0]), binary_addresses=binary_addresses).collect_schema()
+            key_width = sum(20 if schema[key].is_integer() else 64 for key in keys)
+            progress = tqdm(desc='Sorting {}'.format(file))
+            # Buckets still to write, first bucket last
+            pending = sorted(bucket_ids, reverse=True)
+            while pending:
+                bucket_id = pending.pop()
+                bucket_paths = sorted(glob.glob(os.path.join(bucket_dir, bucket_id + '_*.parquet')))
+                if sum(os.path.getsize(path) for path in bucket_paths) <= max_bucket_bytes:
+                    tables = [pl.read_parquet(bucket_paths).sort(keys, nulls_last=True).to_arrow()]
+                else:
+                    # Split the bucket by the byte following the common prefix of its sort keys, then write
+                    # its sub-buckets in order; rows with identical keys are already in order
+                    bounds = (pl.scan_parquet(bucket_paths)
+                              .select(Utils.get_sort_key(schema, keys).alias('key'))
+                              .select(pl.col('key').min().alias('first'), pl.col('key').max().alias('last'))
+                              ).collect()
+                    depth = len(os.path.commonprefix([bounds['first'][0], bounds['last'][0]]))
+                    if depth < key_width:
+                        bucket_ids = set()
+                        for path in bucket_paths:
+                            bucket_ids |= Utils.write_buckets(pl.read_parquet(path), keys, depth + 2, bucket_dir,
+                                                              os.path.basename(path)[:-len('.parquet')].split('_')[1])
+                            os.remove(path)
+                        pending += sorted(bucket_ids, reverse=True)
+                        continue
+                    tables = (pq.read_table(path) for path in bucket_paths)
+                for table in tables:
+                    if writer is None:
+                        writer = pq.ParquetWriter(
+                            file_path + '.tmp', table.schema, compression='zstd')
+                    writer.write_table(table, row_group_size=row_group_size)
+                progress.update(1)
+            progress.close()
+            if writer is None:
+                # No rows: an empty file with the normalised schema
+                pl.DataFrame(schema=schema).write_parquet(file_path + '.tmp')
+            else:
+                writer.close()
+            os.replace(file_path + '.tmp', file_path)
+            shutil.rmtree(bucket_dir)
+
+    def address_column(self, column):
+        # Column to filter or group addresses, hashes and topics on
+        if self.binary_addresses or self.lowercase_addresses:
+            return pl.col(column)
+        return pl.col(column).str.to_lowercase()
+
+    def address_value(self, address):
+        # Literal to compare with address_column
+        if self.binary_addresses:
+            return bytes.fromhex(address[2:])
+        return address.lower()
+
+    def address_values(self, addresses):
+        # Literals to use with address_column(...).is_in
+        addresses = pl.Series(addresses, dtype=pl.String)
+        if self.binary_addresses:
+            return addresses.str.slice(2).str.decode('hex')
+        return addresses.str.to_lowercase()
+
+    def hex_column(self, expr):
+        # Selected address, hash or topic as a 0x-prefixed hex string
+        if self.binary_addresses:
+            return pl.concat_str(pl.lit('0x'), expr.bin.encode('hex'))
+        return expr
+
+    def hex_columns(self, columns):
+        return [self.hex_column(pl.col(column)).alias(column) for column in columns]
+
+    def topic_address(self, column):
+        # Address stored in the last 20 bytes of an indexed topic
+        if self.binary_addresses:
+            return pl.concat_str(pl.lit('0x'), pl.col(column).bin.encode('hex').str.slice(-40))
+        return pl.format("0x{}", pl.col(column).str.slice(-40))
+
     @staticmethod
     def load_contract_settings(data_dir="../data/", chain="mainnet"):
         filedir = os.path.join(data_dir, "contract_config.json")
@@ -39,7 +922,7 @@ class Utils:
 
     @staticmethod
     def check_sig(sig, topic_0):
-        return web3.Web3.keccak(text=sig).hex() == topic_0
+        return event_registry.check(sig, topic_0)
 
     @staticmethod
     def parse_addresses(address):
@@ -77,34 +960,65 @@ class Utils:
         dfs['timestamp'] = pd.to_datetime(dfs['timestamp'])
         return dfs
 
+    @staticmethod
+    def first_value(values):
+        return next((value for value in values if value is not None), None)
+
+    @staticmethod
+    def to_binary_series(name, values):
+        # Binary column of hashes/addresses from HexBytes, checksum addresses or 0x-prefixed hex strings
+        if isinstance(Utils.first_value(values), str):
+            return pl.Series(name, values, dtype=pl.String).str.slice(2).str.decode('hex')
+        return pl.Series(name, values, dtype=pl.Binary)
+
+    @staticmethod
+    def to_int_series(name, values, dtype=pl.Int64):
+        # Integer column from ints or the hex quantities of raw JSON-RPC results
+        if isinstance(Utils.first_value(values), str):
+            return pl.Series(name, values, dtype=pl.String).str.slice(2).str.to_integer(base=16).cast(dtype)
+        return pl.Series(name, values, dtype=dtype)
+
     @staticmethod
     def parse_transactions(txs_raw):
-        txs = list()
-        for tx_raw in txs_raw:
-            tx = dict()
-            tx['blockNumber'] = tx_raw['tx']['blockNumber']
-            tx['blockHash'] = tx_raw['tx']['blockHash'].hex().lower()
-            tx['hash'] = tx_raw['tx']['hash'].hex().lower()
-            tx['from'] = tx_raw['tx']['from'].lower()
-            tx['to'] = tx_raw['tx']['to'].lower() if tx_raw['tx']['to'] else None
-            tx['gas'] = tx_raw['tx']['gas']
-            tx['gasPrice'] = tx_raw['tx']['gasPrice']
-            # tx['input'] = tx_raw['tx']['input'].hex().lower()
-            tx['nonce'] = tx_raw['tx']['nonce']
-            tx['transactionIndex'] = tx_raw['tx']['transactionIndex']
-            tx['type'] = tx_raw['tx']['type']
-            tx['value'] = tx_raw['tx']['value']
-            # tx['v'] = tx_raw['tx']['v']
-            # tx['r'] = tx_raw['tx']['r'].hex().lower()
-            # tx['s'] = tx_raw['tx']['s'].hex().lower()
-            tx['txReceiptContractAddress'] = tx_raw['receipt']['contractAddress'].lower(
-            ) if tx_raw['receipt']['contractAddress'] else None
-            tx['txReceiptCumulativeGasUsed'] = tx_raw['receipt']['cumulativeGasUsed']
-            tx['txReceiptEffectiveGasPrice'] = tx_raw['receipt']['effectiveGasPrice']
-            tx['txReceiptGasUsed'] = tx_raw['receipt']['gasUsed']
-            tx['txReceiptStatus'] = tx_raw['receipt']['status']
-            txs.append(tx)
-        return txs
+        # Batch converter of {'tx', 'receipt'} pairs (web3 formatted or raw=True JSON results) to a polars
+        # DataFrame, one column at a time. Hashes (32 bytes) and addresses (20 bytes) are binary columns and
+        # value is a decimal string column (see to_amount_series), so the frame can be written to parquet
+        # Pairs whose transaction or receipt could not be fetched (None) are skipped and counted
+        n_txs = len(txs_raw)
+        txs_raw = [tx_raw for tx_raw in txs_raw
+                   if tx_raw['tx'] is not None and tx_raw['receipt'] is not None]
+        if len(txs_raw) < n_txs:
+            print('Warning: {} of {} transactions dropped (missing transaction or receipt)'.format(
+                n_txs - len(txs_raw), n_txs))
+        txs = [tx_raw['tx'] for tx_raw in txs_raw]
+        receipts = [tx_raw['receipt'] for tx_raw in txs_raw]
+        values = [tx['value'] for tx in txs]
+        if isinstance(Utils.first_value(values), str):
+            values = [int(value, 16) for value in values]
+        return pl.DataFrame([
+            Utils.to_int_series('blockNumber', [tx['blockNumber'] for tx in txs]),
+            Utils.to_binary_series('blockHash', [tx['blockHash'] for tx in txs]),
+            Utils.to_binary_series('hash', [tx['hash'] for tx in txs]),
+            Utils.to_binary_series('from', [tx['from'] for tx in txs]),
+            Utils.to_binary_series('to', [tx['to'] for tx in txs]),
+            Utils.to_int_series('gas', [tx['gas'] for tx in txs]),
+            Utils.to_int_series('gasPrice', [tx['gasPrice'] for tx in txs]),
+            Utils.to_int_series('nonce', [tx['nonce'] for tx in txs]),
+            Utils.to_int_series('transactionIndex', [
+                                tx['transactionIndex'] for tx in txs]),
+            Utils.to_int_series('type', [tx['type'] for tx in txs]),
+            Utils.to_amount_series('value', values),
+            Utils.to_binary_series('txReceiptContractAddress', [
+                                   receipt['contractAddress'] for receipt in receipts]),
+            Utils.to_int_series('txReceiptCumulativeGasUsed', [
+                                receipt['cumulativeGasUsed'] for receipt in receipts]),
+            Utils.to_int_series('txReceiptEffectiveGasPrice', [
+                                receipt['effectiveGasPrice'] for receipt in receipts]),
+            Utils.to_int_series('txReceiptGasUsed', [
+                                receipt['gasUsed'] for receipt in receipts]),
+            Utils.to_int_series('txReceiptStatus', [
+                                receipt['status'] for receipt in receipts]),
+        ])
 
     @staticmethod
     def parse_common_attributes(event):
@@ -118,78 +1032,85 @@ class Utils:
         data['event'] = event['event']
         return data
 
+    @staticmethod
+    def to_amount_series(name, amounts):
+        # uint256 amounts are always kept exact as decimal strings (String dtype), like the uint256 event
+        # arguments of ethereum.events_to_dataframe: parquet and Arrow cannot store Int128 and a uint256
+        # does not fit in Decimal(38, 0). Cast to Float64 before dividing by the decimals, or use
+        # to_exact_amounts for exact Int128 arithmetic
+        return pl.Series(name, [None if amount is None else str(amount) for amount in amounts], dtype=pl.String)
+
+    @staticmethod
+    def events_to_dataframe(events, address_args=None, amount_args=None):
+        # Columnar builder for web3 events: every column buffer is filled in one pass over the events,
+        # then hashes are hex-encoded and addresses lowercased by vectorised polars expressions
+        # address_args and amount_args map output columns to event arguments
+        address_args = address_args or dict()
+        amount_args = amount_args or dict()
+        events = events if isinstance(events, list) else list(events)
+        columns = [
+            pl.Series('blockNumber', [event['blockNumber']
+                      for event in events], dtype=pl.Int64),
+            pl.Series('transactionHash', [event['transactionHash']
+                      for event in events], dtype=pl.Binary),
+            pl.Series('blockHash', [event['blockHash']
+                      for event in events], dtype=pl.Binary),
+            pl.Series('address', [event['address']
+                      for event in events], dtype=pl.String),
+            pl.Series('transactionIndex', [event['transactionIndex']
+                      for event in events], dtype=pl.Int64),
+            pl.Series('logIndex', [event['logIndex']
+                      for event in events], dtype=pl.Int64),
+            pl.Series('event', [event['event']
+                      for event in events], dtype=pl.String),
+        ]
+        for column, arg in address_args.items():
+            columns.append(pl.Series(column, [event['args'][arg]
+                           for event in events], dtype=pl.String))
+        for column, arg in amount_args.items():
+            columns.append(Utils.to_amount_series(
+                column, [event['args'][arg] for event in events]))
+        return pl.DataFrame(columns).with_columns(
+            [pl.concat_str(pl.lit('0x'), pl.col(column).bin.encode('hex')).alias(column)
+             for column in ['transactionHash', 'blockHash']] +
+            [pl.col(column).str.to_lowercase() for column in ['address', *address_args]])
+
     @staticmethod
     def transfer_to_dataframe(events, amount_colum="amount",
                               dataframe_func=pl.DataFrame,
                               sender="from", receiver="to"):
         # Convert Transfer events data to dataframe
-        df = list()
-        for event in tqdm(events, desc='Loading Transfer events'):
-            data = Utils.parse_common_attributes(event)
-
-            data['from'] = event['args'][sender].lower()
-            data['to'] = event['args'][receiver].lower()
-            data['amount'] = event['args'][amount_colum]
-            df.append(data)
-        return dataframe_func(df)
+        df = Utils.events_to_dataframe(events, address_args={'from': sender, 'to': receiver},
+                                       amount_args={'amount': amount_colum})
+        if dataframe_func is pl.DataFrame:
+            return df
+        return dataframe_func(df.to_dict(as_series=False))
 
     @staticmethod
     def claim_to_dataframe(events, amount_colum="amount", account_column="account"):
         # Convert Claimer events data to dataframe
-        df = list()
-        for event in tqdm(events, desc='Loading Claim events'):
-            data = Utils.parse_common_attributes(event)
-            data['account'] = event['args'][account_column].lower()
-            data['amount'] = event['args'][amount_colum]
-            df.append(data)
-        return pl.DataFrame(df)
+        return Utils.events_to_dataframe(events, address_args={'account': account_column},
+                                         amount_args={'amount': amount_colum})
 
     # Loading account balances history for specific addresses
 
-    @staticmethod
-    def compute_account_balances(transfer_df):
-        balances_history_dict = dict()
-        for _, row in tqdm(transfer_df.iterrows(), desc='Loading balances', total=transfer_df.shape[0]):
-            if row['from'] not in balances_history_dict:
-                balances_history_dict[row['from']] = {
-                    'current': 0, 'history': [], 'n_from': 0, 'n_to': 0}
-            if row['to'] not in balances_history_dict:
-                balances_history_dict[row['to']] = {
-                    'current': 0, 'history': [], 'n_from': 0, 'n_to': 0}
-
-            balance = row['value']
-
-            balances_history_dict[row['from']]['history'].append(
-                {'block_number': row['blockNumber'], 'timestamp': row['timestamp'],
-                 'balance_before': balances_history_dict[row['from']]['current'],
-                 'balance_after': balances_history_dict[row['from']]['current']-balance})
-            balances_history_dict[row['to']]['history'].append(
-                {'block_number': row['blockNumber'], 'timestamp': row['timestamp'],
-                 'balance_before': balances_history_dict[row['to']]['current'],
-                 'balance_after': balances_history_dict[row['to']]['current']+balance})
-
-            balances_history_dict[row['from']]['n_from'] += 1
-            balances_history_dict[row['to']]['n_to'] += 1
-
-            balances_history_dict[row['from']]['current'] -= balance
-            balances_history_dict[row['to']]['current'] += balance
-
-        print("There are in total {} addresses".format(
-            len(balances_history_dict)))
-        return balances_history_dict
-
+    @cached_query('transactions', 'blocks')
     def get_txs(self, inscriptions_tag):
         txs = (pl.scan_parquet(self.data_path['transactions'])
                # .filter(pl.col('from').eq(pl.col('to')) & pl.col('input').str.starts_with(inscriptions_tag))
                .filter(pl.col('input').str.starts_with(inscriptions_tag))
                .select([
                    pl.col('blockNumber').alias('block_number'),
-                   pl.col('hash').alias('tx_hash'),
+                   self.hex_column(pl.col('hash')).alias('tx_hash'),
                    pl.col('input').alias('tx_input_data'),
-                   pl.col('from').str.to_lowercase().alias('issuer'),
-                   pl.col('to').str.to_lowercase().alias('receiver'),
+                   self.hex_column(self.address_column(
+                       'from')).alias('issuer'),
+                   self.hex_column(self.address_column(
+                       'to')).alias('receiver'),
                ])
                )
+        if self.timestamp_index is not None:
+            return self.add_timestamps(txs.collect(streaming=True), 'block_number')
         blocks = (
             pl.scan_parquet(self.data_path['blocks'])
             .select(pl.col('number').alias('block_number'), pl.from_epoch(pl.col('timestamp')))
@@ -199,13 +1120,14 @@ class Utils:
 
         return q.collect(streaming=True)
 
+    @cached_query('tx_receipts')
     def get_receipts(self, wallet_addresses):
         q = (pl.scan_parquet(self.data_path['tx_receipts'])
              # .filter(pl.col('from').eq(pl.col('to')))
              # .filter(pl.col('from').str.to_lowercase().is_in(wallet_addresses) | pl.col('to').str.to_lowercase().is_in(wallet_addresses))
-             .filter(pl.col('from').str.to_lowercase().is_in(wallet_addresses))
+             .filter(self.address_column('from').is_in(self.address_values(wallet_addresses)))
              .select([
-                 pl.col('transactionHash').alias('tx_hash'),
+                 self.hex_column(pl.col('transactionHash')).alias('tx_hash'),
                  pl.col('gasUsed').alias('gas_used'),
                  pl.col('effectiveGasPrice').alias('gas_effective_price'),
                  pl.col('gasUsed').mul(
@@ -215,18 +1137,23 @@ class Utils:
              )
         return q.collect(streaming=True)
 
+    @cached_query('transactions', 'blocks')
     def get_txs(self, inscriptions_tag):
         txs = (pl.scan_parquet(self.data_path['transactions'])
                # .filter(pl.col('from').eq(pl.col('to')) & pl.col('input').str.starts_with(inscriptions_tag))
                .filter(pl.col('input').str.starts_with(inscriptions_tag))
                .select([
                    pl.col('blockNumber').alias('block_number'),
-                   pl.col('hash').alias('tx_hash'),
+                   self.hex_column(pl.col('hash')).alias('tx_hash'),
                    pl.col('input').alias('tx_input_data'),
-                   pl.col('from').str.to_lowercase().alias('issuer'),
-                   pl.col('to').str.to_lowercase().alias('receiver'),
+                   self.hex_column(self.address_column(
+                       'from')).alias('issuer'),
+                   self.hex_column(self.address_column(
+                       'to')).alias('receiver'),
                ])
                )
+        if self.timestamp_index is not None:
+            return self.add_timestamps(txs.collect(streaming=True), 'block_number')
         blocks = (
             pl.scan_parquet(self.data_path['blocks'])
             .select(pl.col('number').alias('block_number'), pl.from_epoch(pl.col('timestamp')))
@@ -236,13 +1163,14 @@ class Utils:
 
         return q.collect(streaming=True)
 
+    @cached_query('tx_receipts')
     def get_receipts(self, wallet_addresses):
         q = (pl.scan_parquet(self.data_path['tx_receipts'])
              # .filter(pl.col('from').eq(pl.col('to')))
              # .filter(pl.col('from').str.to_lowercase().is_in(wallet_addresses) | pl.col('to').str.to_lowercase().is_in(wallet_addresses))
-             .filter(pl.col('from').str.to_lowercase().is_in(wallet_addresses))
+             .filter(self.address_column('from').is_in(self.address_values(wallet_addresses)))
              .select([
-                 pl.col('transactionHash').alias('tx_hash'),
+                 self.hex_column(pl.col('transactionHash')).alias('tx_hash'),
                  pl.col('gasUsed').alias('gas_used'),
                  pl.col('effectiveGasPrice').alias('gas_effective_price'),
                  pl.col('gasUsed').mul(
@@ -252,88 +1180,130 @@ class Utils:
              )
         return q.collect(streaming=True)
 
+    def scan_blocks_stats(self):
+        is_mined = pl.col('number') > 0
+        return (
+            pl.scan_parquet(self.data_path['blocks'])
+            .select([pl.col('number').filter(is_mined).min().alias('min_number'),
+                     pl.col('number').filter(is_mined).max().alias('max_number'),
+                     pl.from_epoch(pl.col('timestamp').filter(is_mined).min()
+                                   ).alias('min_timestamp'),
+                     pl.from_epoch(pl.col('timestamp').filter(
+                         is_mined).max()).alias('max_timestamp'),
+                     pl.col('hash').n_unique().alias('n_blocks')])
+        )
+
+    def scan_transactions_stats(self, contract_addresses=()):
+        # Per contract: unique transactions sent from, sent to, and sent from or to the contract
+        aggregates = [pl.len().alias('n_transactions')]
+        for index, contract_address in enumerate(contract_addresses):
+            is_from = self.address_column(
+                'from') == self.address_value(contract_address)
+            is_to = self.address_column(
+                'to') == self.address_value(contract_address)
+            aggregates += [pl.col('hash').filter(is_from).n_unique().alias('{}_from'.format(index)),
+                           pl.col('hash').filter(is_to).n_unique().alias(
+                               '{}_to'.format(index)),
+                           pl.col('hash').filter(is_from | is_to).n_unique().alias('{}_from_to'.format(index))]
+        return pl.scan_parquet(self.data_path['transactions']).select(aggregates)
+
+    def scan_logs_stats(self, contract_addresses=()):
+        # Per contract: events emitted by the contract and the unique transactions emitting them
+        aggregates = [pl.len().alias('n_logs')]
+        for index, contract_address in enumerate(contract_addresses):
+            is_contract = self.address_column(
+                'address') == self.address_value(contract_address)
+            aggregates += [is_contract.sum().alias('{}_n_logs'.format(index)),
+                           pl.col('transactionHash').filter(is_contract).n_unique().alias(
+                               '{}_n_log_transactions'.format(index))]
+        return pl.scan_parquet(self.data_path['logs']).select(aggregates)
+
+    def get_dataset_stats(self, contract_addresses=(), files=('blocks', 'transactions', 'logs')):
+        # Dataset overview in one streaming pass per source, the sources being read concurrently by collect_all
+        # {'min_number': ..., 'n_blocks': ..., 'n_transactions': ..., 'n_logs': ...,
+        #  'contracts': {contract_address: {'from': ..., 'to': ..., 'from_to': ..., 'n_logs': ..., ...}}}
+        contract_addresses = list(contract_addresses)
+        queries = {'blocks': self.scan_blocks_stats,
+                   'transactions': lambda: self.scan_transactions_stats(contract_addresses),
+                   'logs': lambda: self.scan_logs_stats(contract_addresses)}
+        results = pl.collect_all([queries[file]()
+                                 for file in files], streaming=True)
+        stats = {'contracts': {contract_address: dict()
+                               for contract_address in contract_addresses}}
+        for result in results:
+            for column, value in result.row(0, named=True).items():
+                index, _, stat = column.partition('_')
+                if index.isdigit():
+                    stats['contracts'][contract_addresses[int(index)]][stat] = value
+                else:
+                    stats[column] = value
+        return stats
+
+    @cached_query('blocks')
     def get_min_max_blocks(self):
         # get the min and max block number
         q = (
-            pl.scan_parquet(self.data_path['blocks'])
-            .filter(pl.col('number') > 0)
-            .select([pl.col('number').min().alias('min_number'),
-                    pl.col('number').max().alias('max_number'),
-                    pl.from_epoch(pl.col('timestamp').min()
-                                  ).alias('min_timestamp'),
-                    pl.from_epoch(pl.col('timestamp').max()).alias('max_timestamp')])
+            self.scan_blocks_stats()
+            .select(['min_number', 'max_number', 'min_timestamp', 'max_timestamp'])
         )
         return q.collect(streaming=True)
 
+    @cached_query('transactions')
     def get_num_transactions(self):
-        q = (
-            pl.scan_parquet(self.data_path['transactions'])
-            .select(pl.len())
-        )
-        return q.collect(streaming=True).rows()[0][0]
+        return self.scan_transactions_stats().collect(streaming=True).rows()[0][0]
 
+    @cached_query('blocks')
     def get_num_blocks(self):
-        q = (
-            pl.scan_parquet(self.data_path['blocks'])
-            .select(pl.col('hash').n_unique())
-        )
-        return q.collect(streaming=True).rows()[0][0]
+        return self.scan_blocks_stats().select('n_blocks').collect(streaming=True).rows()[0][0]
 
+    @cached_query('logs', label='topics_0')
     def get_events_from_contract_address(self, contract_address):
         q = (
             pl.scan_parquet(self.data_path['logs'])
-            .filter(pl.col('address').str.to_lowercase() == contract_address.lower())
-            .select(pl.col('topics_0').unique().alias('topics_0'))
+            .filter(self.address_column('address') == self.address_value(contract_address))
+            .select(self.hex_column(pl.col('topics_0').unique()).alias('topics_0'))
         )
         return q.collect(streaming=True)
 
+    @cached_query('logs', label='topics_0')
     def get_topics_0_count(self, contract_address):
         q = (
             pl.scan_parquet(self.data_path['logs'])
-            .filter(pl.col('address').str.to_lowercase() == contract_address)
+            .filter(self.address_column('address') == self.address_value(contract_address))
             .group_by(pl.col('topics_0'))
             .agg(pl.len())
+            .with_columns(self.hex_column(pl.col('topics_0')).alias('topics_0'))
             .sort(pl.col('len'), descending=True)
         )
         return q.collect(streaming=True)
 
+    @cached_query('transactions')
     def get_count_unique_transactions_per_contract(self, contract_address):
-        response = dict()
-        response['from'] = (
-            pl.scan_parquet(self.data_path['transactions'])
-            .filter(pl.col('from').str.to_lowercase() == contract_address)
-            .select(pl.col('hash').n_unique())
-        ).collect(streaming=True)['hash'][0]
-        response['to'] = (
-            pl.scan_parquet(self.data_path['transactions'])
-            .filter(pl.col('to').str.to_lowercase() == contract_address)
-            .select(pl.col('hash').n_unique())
-        ).collect(streaming=True)['hash'][0]
-
-        response['from_to'] = (
-            pl.scan_parquet(self.data_path['transactions'])
-            .filter((pl.col('from').str.to_lowercase() == contract_address) | (pl.col('to').str.to_lowercase() == contract_address))
-            .select(pl.col('hash').n_unique())
-        ).collect(streaming=True)['hash'][0]
-        return response
+        # Single pass over the transactions for the three counts
+        stats = self.get_dataset_stats(
+            [contract_address], files=('transactions',))
+        return stats['contracts'][contract_address]
 
+    @cached_query('logs')
     def get_unique_transactions_calling_contract(self, contract_address):
         q = (
             pl.scan_parquet(self.data_path['logs'])
-            .filter(pl.col('address').str.to_lowercase() == contract_address)
-            .select(pl.col('transactionHash').unique())
+            .filter(self.address_column('address') == self.address_value(contract_address))
+            .select(self.hex_column(pl.col('transactionHash').unique()).alias('transactionHash'))
         )
         return q.collect(streaming=True)
 
+    @cached_query('logs', label='topics_0')
     def get_contract_events(self, contract_address):
         q = (
             pl.scan_parquet(self.data_path['logs'])
-            .filter(pl.col('address').str.to_lowercase() == contract_address)
+            .filter(self.address_column('address') == self.address_value(contract_address))
             .select(pl.col(
                 ['blockNumber', 'transactionHash', 'transactionIndex', 'logIndex',
                  'topics_0', 'topics_1', 'topics_2', 'topics_3',
                  'data']
             ))
+            .with_columns(self.hex_columns(['transactionHash', 'topics_0', 'topics_1', 'topics_2', 'topics_3']))
             .sort(pl.col(['blockNumber', 'transactionIndex', 'logIndex']))
         )
         return q.collect(streaming=True)
@@ -342,42 +1312,44 @@ class Utils:
         q = (
             pl.scan_parquet(self.data_path['logs'])
             .filter(
-                (pl.col('address').str.to_lowercase() == contract_address)
+                (self.address_column('address') == self.address_value(contract_address))
                 &
-                (pl.col('topics_0').eq("0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef")))
+                (pl.col('topics_0') == self.address_value(TRANSFER_TOPIC)))
             .select([
                 pl.col('blockNumber'),
-                pl.col('transactionHash'),
+                self.hex_column(pl.col('transactionHash')
+                                ).alias('transactionHash'),
                 pl.col('transactionIndex'),
                 pl.col('logIndex'),
-                pl.format("0x{}", pl.col(
-                    'topics_1').str.slice(-40)).alias('sender'),
-                pl.format("0x{}", pl.col('topics_2').str.slice(-40)
-                          ).alias('receiver'),
+                self.topic_address('topics_1').alias('sender'),
+                self.topic_address('topics_2').alias('receiver'),
                 pl.col('data').str.replace('0x', '0x0').alias('amount')
             ])
         )
         return q.collect(streaming=True)
 
+    @cached_query('logs', 'blocks')
     def get_contract_transfer_events(self, contract_address):
         txs = (
             pl.scan_parquet(self.data_path['logs'])
             .filter(
-                (pl.col('address').str.to_lowercase() == contract_address)
+                (self.address_column('address') == self.address_value(contract_address))
                 &
-                (pl.col('topics_0').eq("0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef")))
+                (pl.col('topics_0') == self.address_value(TRANSFER_TOPIC)))
             .select([
                 pl.col('blockNumber'),
-                pl.col('transactionHash'),
+                self.hex_column(pl.col('transactionHash')
+                                ).alias('transactionHash'),
                 pl.col('transactionIndex'),
                 pl.col('logIndex'),
-                pl.format("0x{}", pl.col(
-                    'topics_1').str.slice(-40)).alias('sender'),
-                pl.format("0x{}", pl.col('topics_2').str.slice(-40)
-                          ).alias('receiver'),
+                self.topic_address('topics_1').alias('sender'),
+                self.topic_address('topics_2').alias('receiver'),
                 pl.col('data').str.replace('0x', '0x0').alias('amount')
             ])
         )
+        if self.timestamp_index is not None:
+            return self.add_timestamps(
+                txs.sort(pl.col(['blockNumber', 'transactionIndex', 'logIndex'])).collect(streaming=True))
         blocks = (
             pl.scan_parquet(self.data_path['blocks'])
             .select(pl.col('number'), pl.from_epoch(pl.col('timestamp')))
@@ -386,44 +1358,133 @@ class Utils:
             pl.col(['blockNumber', 'transactionIndex', 'logIndex']))
         return q.collect(streaming=True)
 
+    def scan_protocols_logs(self, contract_settings):
+        # Logs of all the contracts of contract_settings (load_contract_settings) tagged with their protocol
+        protocols = pl.DataFrame({
+            'protocol': list(contract_settings),
+            'contract': self.address_values([settings['address'] for settings in contract_settings.values()])})
+        return (
+            pl.scan_parquet(self.data_path['logs'])
+            .filter(self.address_column('address').is_in(protocols['contract']))
+            .join(protocols.lazy(), left_on=self.address_column('address'), right_on='contract')
+        )
+
+    @staticmethod
+    def partition_by_protocol(df, contract_settings):
+        # {protocol: dataframe}, with an empty dataframe for the protocols without events
+        partitions = df.partition_by('protocol', as_dict=True, include_key=False)
+        return {protocol: partitions.get((protocol,), df.clear().drop('protocol'))
+                for protocol in contract_settings}
+
+    @cached_query('logs', label='topics_0')
+    def get_protocols_events(self, contract_settings, topics_0=None):
+        # Batched get_contract_events: a single logs scan for all the protocols of contract_settings
+        # topics_0 optionally restricts the events (e.g. the Transfer and claim topics)
+        q = self.scan_protocols_logs(contract_settings)
+        if topics_0 is not None:
+            q = q.filter(pl.col('topics_0').is_in(
+                self.address_values(topics_0)))
+        q = (q
+             .select(pl.col(
+                 ['protocol', 'blockNumber', 'transactionHash', 'transactionIndex', 'logIndex',
+                  'topics_0', 'topics_1', 'topics_2', 'topics_3',
+                  'data']
+             ))
+             .with_columns(self.hex_columns(['transactionHash', 'topics_0', 'topics_1', 'topics_2', 'topics_3']))
+             .sort(pl.col(['protocol', 'blockNumber', 'transactionIndex', 'logIndex']))
+             )
+        return Utils.partition_by_protocol(q.collect(streaming=True), contract_settings)
+
+    @cached_query('logs', 'blocks')
+    def get_protocols_transfer_events(self, contract_settings):
+        # Batched get_contract_transfer_events: a single logs scan for all the protocols of contract_settings
+        txs = (
+            self.scan_protocols_logs(contract_settings)
+            .filter(pl.col('topics_0') == self.address_value(TRANSFER_TOPIC))
+            .select([
+                pl.col('protocol'),
+                pl.col('blockNumber'),
+                self.hex_column(pl.col('transactionHash')
+                                ).alias('transactionHash'),
+                pl.col('transactionIndex'),
+                pl.col('logIndex'),
+                self.topic_address('topics_1').alias('sender'),
+                self.topic_address('topics_2').alias('receiver'),
+                pl.col('data').str.replace('0x', '0x0').alias('amount')
+            ])
+            .sort(pl.col(['protocol', 'blockNumber', 'transactionIndex', 'logIndex']))
+        )
+        if self.timestamp_index is not None:
+            df = self.add_timestamps(txs.collect(streaming=True))
+        else:
+            blocks = (
+                pl.scan_parquet(self.data_path['blocks'])
+                .select(pl.col('number'), pl.from_epoch(pl.col('timestamp')))
+            )
+            df = txs.join(blocks, left_on='blockNumber', right_on='number', how='left').sort(
+                pl.col(['protocol', 'blockNumber', 'transactionIndex', 'logIndex'])).collect(streaming=True)
+        return Utils.partition_by_protocol(df, contract_settings)
+
+    @cached_query('logs', label='topics_0')
     def get_events_from_transactions(self, transactions):
         q = (
             pl.scan_parquet(self.data_path['logs'])
-            .filter(pl.col('transactionHash').is_in(transactions['transactionHash']))
+            .filter(pl.col('transactionHash').is_in(self.address_values(transactions['transactionHash'])))
             .select(pl.col(
                 ['blockNumber', 'transactionHash', 'transactionIndex',
                  'logIndex', 'topics_0', 'topics_1', 'topics_2', 'topics_3',
                  'data']
             ))
+            .with_columns(self.hex_columns(['transactionHash', 'topics_0', 'topics_1', 'topics_2', 'topics_3']))
             .sort(pl.col(['blockNumber', 'transactionIndex', 'logIndex']))
         )
         return q.collect(streaming=True)
 
+    @cached_query('logs', label='topics_0')
     def get_contract_calls(self, contract_address):
         contract_address = contract_address.lower()
+        if self.binary_addresses:
+            # Indexed addresses are left-padded to 32 bytes
+            topic = bytes(12) + self.address_value(contract_address)
+            is_called = (pl.col('topics_1') == topic) | (
+                pl.col('topics_2') == topic)
+        else:
+            # Only 32-byte topics hold an address (the topic address index is restricted to them as well)
+            is_called = ((pl.col('topics_1').str.len_bytes() == 66) &
+                         (self.topic_address('topics_1').str.to_lowercase() == contract_address)) | (
+                (pl.col('topics_2').str.len_bytes() == 66) &
+                (self.topic_address('topics_2').str.to_lowercase() == contract_address))
+        if self.topic_index is not None:
+            logs = self.topic_index.get_logs(contract_address, columns=[
+                'blockNumber', 'transactionHash', 'transactionIndex', 'logIndex', 'address',
+                'topics_0', 'topics_1', 'topics_2', 'topics_3', 'data']).lazy()
+        else:
+            logs = pl.scan_parquet(self.data_path['logs'])
         q = (
-            pl.scan_parquet(self.data_path['logs'])
-            .filter(
-                (pl.col('topics_1').map_elements(Utils.parse_addresses) == contract_address) | (
-                    pl.col('topics_2').map_elements(Utils.parse_addresses) == contract_address))
+            logs
+            .filter(is_called)
             .select(pl.col(
                 ['blockNumber', 'transactionHash', 'transactionIndex',
                  'logIndex', 'address',
                  'topics_0', 'topics_1', 'topics_2', 'topics_3',
                  'data']
             ))
+            .with_columns(self.hex_columns(['transactionHash', 'address', 'topics_0', 'topics_1', 'topics_2', 'topics_3']))
             .sort(pl.col(['blockNumber', 'transactionIndex', 'logIndex']))
         )
         return q.collect(streaming=True)
 
+    @cached_query('tx_receipts', 'blocks')
     def get_fees_spent(self, user_address):
         txs = (
             pl.scan_parquet(self.data_path['tx_receipts'])
-            .filter(pl.col('from').str.to_lowercase() == user_address)
+            .filter(self.address_column('from') == self.address_value(user_address))
             .select(pl.col('blockNumber'), pl.col('gasUsed'),
                     pl.col('effectiveGasPrice'),
                     pl.col('gasUsed').mul(pl.col('effectiveGasPrice')).alias('fees'))
         ).collect(streaming=True)
+        if self.timestamp_index is not None:
+            return self.add_timestamps(txs)
         min_block = txs['blockNumber'].min()
         max_block = txs['blockNumber'].max()
         blocks = (
@@ -433,14 +1494,17 @@ class Utils:
         ).collect(streaming=True)
         return txs.join(blocks, left_on='blockNumber', right_on='number', how='left')
 
+    @cached_query('tx_receipts', 'blocks')
     def get_fees_spent_by_contract(self, contract_address):
         txs = (
             pl.scan_parquet(self.data_path['tx_receipts'])
-            .filter(pl.col('from').str.to_lowercase() == contract_address)
+            .filter(self.address_column('from') == self.address_value(contract_address))
             .select(pl.col('blockNumber'), pl.col('gasUsed'),
                     pl.col('effectiveGasPrice'),
                     pl.col('gasUsed').mul(pl.col('effectiveGasPrice')).alias('fees'))
         ).collect(streaming=True)
+        if self.timestamp_index is not None:
+            return self.add_timestamps(txs)
         min_block = txs['blockNumber'].min()
         max_block = txs['blockNumber'].max()
         blocks = (
@@ -450,56 +1514,132 @@ class Utils:
         ).collect(streaming=True)
         return txs.join(blocks, left_on='blockNumber', right_on='number', how='left')
 
-    def compute_account_balances(self, transfer_df):
-        # Loading account balances history for specific addresses
-        balances_history_dict = dict()
-        for row in tqdm(transfer_df.iter_rows(named=True), desc='Loading balances', total=transfer_df.shape[0]):
-            if row['sender'] not in balances_history_dict:
-                balances_history_dict[row['sender']] = {
-                    'current': 0, 'history': [], 'n_sender': 0, 'n_receiver': 0}
-            if row['receiver'] not in balances_history_dict:
-                balances_history_dict[row['receiver']] = {
-                    'current': 0, 'history': [], 'n_sender': 0, 'n_receiver': 0}
-
-            balance = row['amount']/1e18
-
-            balances_history_dict[row['sender']]['history'].append(
-                {'block_number': row['blockNumber'], 'timestamp': row['timestamp'],
-                 'balance': balances_history_dict[row['sender']]['current']-balance})
-            balances_history_dict[row['receiver']]['history'].append(
-                {'block_number': row['blockNumber'], 'timestamp': row['timestamp'],
-                 'balance': balances_history_dict[row['receiver']]['current']+balance})
-
-            balances_history_dict[row['sender']]['n_sender'] += 1
-            balances_history_dict[row['receiver']]['n_receiver'] += 1
-
-            balances_history_dict[row['sender']]['current'] -= balance
-            balances_history_dict[row['receiver']]['current'] += balance
-
-        print("There are in total {} addresses".format(
-            len(balances_history_dict)))
-        return balances_history_dict
+    @staticmethod
+    def to_exact_amounts(amounts):
+        # Token amounts as Int128 from integers, decimal strings or the 0x-prefixed hex data of the logs
+        # (uint256 values up to 2**127 - 1, which covers the supply of every token of the dataset)
+        if amounts.dtype.is_integer():
+            return amounts.cast(pl.Int128)
+        if amounts.dtype != pl.String:
+            raise ValueError(
+                "Amounts of type {} are not exact".format(amounts.dtype))
+        if not amounts.str.starts_with('0x').any():
+            return amounts.cast(pl.Int128)
+        digits = amounts.str.slice(2).str.strip_chars_start('0')
+        if ((digits.str.len_bytes() > 32) | ((digits.str.len_bytes() == 32) & (digits.str.slice(0, 1) > '7'))).any():
+            raise ValueError("Amounts larger than 2**127 - 1")
+        # Four 32-bit chunks combined in Int128 arithmetic
+        # (polars only supports Int128 additions between Series, not between column expressions)
+        chunks = (digits.str.zfill(32).to_frame('digits')
+                  .select([(pl.col('digits').str.slice(8 * index, 8).str.to_integer(base=16).cast(pl.Int128) *
+                            pl.lit(2**(32 * (3 - index)), dtype=pl.Int128)).alias(str(index))
+                           for index in range(4)]))
+        return functools.reduce(lambda x, y: x + y, chunks.get_columns()).alias(amounts.name)
 
+    @staticmethod
+    def compute_account_balances(transfer_df, sender='sender', receiver='receiver', amount='amount'):
+        # Balance history of every address in exact integer arithmetic (Int128 token units, not divided by
+        # the decimals). Each transfer is split into a debit leg for the sender and a credit leg for the
+        # receiver, and the balances are the cumulative sum of the legs per address in block/tx/log order
+        # Returns the history (one row per leg) and the accounts (current balance, n_sender, n_receiver)
+        if isinstance(transfer_df, pl.LazyFrame):
+            transfer_df = transfer_df.collect()
+        elif not isinstance(transfer_df, pl.DataFrame):
+            transfer_df = pl.from_pandas(transfer_df)
+        order = [column for column in ['blockNumber', 'transactionIndex', 'logIndex']
+                 if column in transfer_df.columns]
+        columns = order + \
+            [column for column in ['timestamp'] if column in transfer_df.columns]
+        transfers = (transfer_df
+                     .with_columns(Utils.to_exact_amounts(transfer_df[amount]).alias('amount'))
+                     .sort(order, maintain_order=True))
+        n_transfers = transfers.height
+        legs = pl.concat([
+            transfers.select([pl.lit(0, dtype=pl.UInt8).alias('leg'), pl.col(sender).alias('address'),
+                              (pl.lit(0, dtype=pl.Int128) - pl.col('amount')).alias('delta'), *columns]),
+            transfers.select([pl.lit(1, dtype=pl.UInt8).alias('leg'), pl.col(receiver).alias('address'),
+                              pl.col('amount').alias('delta'), *columns]),
+        ])
+        # Debit then credit leg of every transfer
+        legs = legs[np.column_stack([np.arange(n_transfers),
+                                     np.arange(n_transfers) + n_transfers]).ravel()]
+
+        # Group the legs by address with a stable sort of the address hashes, which keeps the transfer
+        # order within every address; on a hash collision the addresses themselves are sorted
+        hashes = legs['address'].hash(seed=0).to_numpy()
+        by_address = np.argsort(hashes, kind='stable')
+        addresses = legs['address'].gather(by_address)
+        is_start = np.r_[True, hashes[by_address][1:]
+                         != hashes[by_address][:-1]][:len(by_address)]
+        if (addresses.ne_missing(addresses.shift(1)).to_numpy() & ~is_start).any():
+            by_address = legs.with_row_index('row').sort(
+                'address', maintain_order=True)['row'].to_numpy()
+            addresses = legs['address'].gather(by_address)
+            is_start = addresses.ne_missing(addresses.shift(1)).to_numpy()
+            is_start[:1] = True
+        starts = np.flatnonzero(is_start)
+        ends = np.r_[starts[1:], len(by_address)][:len(starts)] - 1
+
+        # Running balance: cumulative sum of the legs minus the cumulative sum before the address
+        deltas = legs['delta'].gather(by_address)
+        totals = deltas.cum_sum()
+        offsets = (totals - deltas).gather(starts[np.cumsum(is_start) - 1])
+        balances = totals - offsets
+        positions = np.empty_like(by_address)
+        positions[by_address] = np.arange(len(by_address))
+        balances_after = balances.gather(positions)
+        history = (legs
+                   .with_columns(legs['delta'].alias('delta'),
+                                 (balances_after - legs['delta']).alias('balance_before'),
+                                 balances_after.alias('balance_after'))
+                   .select(['address', *columns, 'delta', 'balance_before', 'balance_after'])
+                   .rename({'blockNumber': 'block_number'}, strict=False))
+
+        n_receiver = np.add.reduceat(legs['leg'].to_numpy()[by_address].astype(np.int64), starts) \
+            if len(starts) else np.zeros(0, dtype=np.int64)
+        accounts = pl.DataFrame([
+            addresses.gather(starts).alias('address'),
+            balances.gather(ends).alias('current'),
+            pl.Series('n_sender', ends - starts + 1 - n_receiver),
+            pl.Series('n_receiver', n_receiver),
+        ]).sort('address')
+        print("There are in total {} addresses".format(accounts.height))
+        return history, accounts
+
+    @cached_query()
     def count_occurrences(self, file, column):
         q = (
             pl.scan_parquet(self.data_path[file])
-            .group_by(pl.col(column).str.to_lowercase())
+            .group_by(self.address_column(column))
             .agg(pl.len())
+            .with_columns(self.hex_column(pl.col(column)).alias(column))
             .sort(pl.col('len'), descending=True)
         )
         return q.collect(streaming=True)
 
+    @cached_query('transactions')
     def get_total_txs_per_address(self):
         q = (
             pl.scan_parquet(self.data_path['transactions'])
             .group_by('from')
             .agg(pl.len('from').alias('n_txs'))
-            .select([pl.col('from').str.to_lowercase().alias('address'), pl.col('n_txs')])
+            .select([self.hex_column(self.address_column('from')).alias('address'), pl.col('n_txs')])
             .sort('n_txs', descending=True)
         )
         return q.collect(streaming=True)
 
+    @cached_query('transactions', 'blocks')
     def get_total_transactions_per_day(self):
+        if self.timestamp_index is not None:
+            # Count per block while scanning, then map the blocks to dates with the index
+            q = (pl.scan_parquet(self.data_path['transactions'])
+                 .group_by('blockNumber')
+                 .agg(pl.len())
+                 ).collect(streaming=True)
+            return (self.add_timestamps(q)
+                    .group_by(pl.col('timestamp').cast(pl.Date).alias('date'))
+                    .agg(pl.col('len').sum())
+                    .sort(pl.col('date')))
         q_1 = (pl.scan_parquet(self.data_path['transactions'])
                # .filter(pl.col('blockNumber').is_between(min_block, max_block))
                .select('blockNumber')
@@ -532,11 +1672,21 @@ class Utils:
     #          )
     #     return q.collect(streaming=True)
 
+    @cached_query('transactions', 'blocks')
     def get_transactions_per_day_per_contract(self, contract_addresses):
         q_1 = (pl.scan_parquet(self.data_path['transactions'])
-               .filter(pl.col('to').str.to_lowercase().is_in(contract_addresses))
-               .select(pl.col('blockNumber'), pl.col('to').alias('contractAddress').str.to_lowercase())
+               .filter(self.address_column('to').is_in(self.address_values(contract_addresses)))
+               .select(pl.col('blockNumber'), self.hex_column(self.address_column('to')).alias('contractAddress'))
                )
+        if self.timestamp_index is not None:
+            q = (q_1
+                 .group_by([pl.col('contractAddress'), pl.col('blockNumber')])
+                 .agg(pl.len())
+                 ).collect(streaming=True)
+            return (self.add_timestamps(q)
+                    .group_by([pl.col('contractAddress'), pl.col('timestamp').cast(pl.Date).alias('date')])
+                    .agg(pl.col('len').sum())
+                    .sort(pl.col('date')))
         q_2 = (pl.scan_parquet(self.data_path['blocks'])
                .select(pl.col('number'), pl.col('timestamp'))
                )
@@ -936,13 +2086,12 @@ events_dict['0xfc30cddea38e2bf4d6ea7d3f9ed3b6ad7f176419f4963bd81318067a4aee73fe'
 }
 
 
+event_registry = EventRegistry(events_dict)
+
+
 def get_event_name(signature):
-    if signature in events_dict:
-        return events_dict[signature]['name']
-    return 'Unknown'
+    return event_registry.get_name(signature)
 
 
 def get_event_signature(signature):
-    if signature in events_dict:
-        return events_dict[signature]['signature']
-    return 'Unknown'
+    return event_registry.get_signature(signature)
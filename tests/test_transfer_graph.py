@@ -0,0 +1,152 @@
+# TransferGraph CSR layout, multi_source_bfs against networkx and earliest_arrival against a brute force
+# search of the time-respecting paths, on small random graphs
+
+import networkx as nx
+import numpy as np
+import polars as pl
+import pytest
+
+from transfer_graph import MISSING_TIMESTAMP, TransferGraph, earliest_arrival, multi_source_bfs
+
+
+def random_transfers(rng, n_nodes, n_edges, n_blocks=20):
+    return pl.DataFrame({'from': ['0x{:040x}'.format(node) for node in rng.integers(0, n_nodes, n_edges)],
+                         'to': ['0x{:040x}'.format(node) for node in rng.integers(0, n_nodes, n_edges)],
+                         'amount': rng.random(n_edges),
+                         'blockNumber': rng.integers(0, n_blocks, n_edges)})
+
+
+def test_csr_matches_edge_list():
+    rng = np.random.default_rng(0)
+    transfers = random_transfers(rng, 30, 200)
+    graph = TransferGraph.from_dataframe(transfers)
+    assert graph.number_of_edges() == transfers.height
+    assert list(graph.addresses) == sorted(set(transfers['from']) | set(transfers['to']))
+    for address in graph.addresses:
+        sent = transfers.filter(pl.col('from') == address)
+        received = transfers.filter(pl.col('to') == address)
+        # Neighbours in transfer order, one per edge
+        assert list(graph.get_addresses(graph.get_neighbors(address))) == sent['to'].to_list()
+        assert list(graph.get_addresses(graph.get_neighbors(address, reverse=True))) == received['from'].to_list()
+        assert graph.amounts[graph.get_edges(address)].tolist() == sent['amount'].to_list()
+    assert graph.out_degree().sum() == graph.in_degree().sum() == transfers.height
+    assert not graph.has_node('0x' + 'f' * 40)
+
+
+def test_null_endpoints_are_dropped():
+    transfers = pl.DataFrame({'from': ['0xa', None, '0xb'], 'to': ['0xb', '0xa', None],
+                              'blockNumber': [1, 2, 3]})
+    graph = TransferGraph.from_dataframe(transfers)
+    assert graph.number_of_edges() == 1
+    assert list(graph.addresses) == ['0xa', '0xb']
+    assert graph.sources.tolist() == [0] and graph.targets.tolist() == [1]
+
+
+def test_null_timestamps_are_missing():
+    transfers = pl.DataFrame({'from': ['0xa', '0xb', '0xa'], 'to': ['0xb', '0xc', '0xc'],
+                              'blockNumber': [1, 2, 3], 'timestamp': [None, 1_700_000_000, None]},
+                             schema_overrides={'timestamp': pl.Int64})
+    graph = TransferGraph.from_dataframe(transfers)
+    assert graph.timestamps.tolist() == [MISSING_TIMESTAMP, 1_700_000_000, MISSING_TIMESTAMP]
+    assert graph.to_dataframe()['timestamp'].to_list() == [None, 1_700_000_000, None]
+    # Unparsable str(datetime) of the networkx graphs, and NaN given to the constructor
+    G = nx.MultiDiGraph()
+    G.add_edge('0xa', '0xb', amount=1., block_number=1, timestamp='None')
+    G.add_edge('0xb', '0xc', amount=1., block_number=2, timestamp='2023-11-14 22:13:20')
+    assert TransferGraph.from_networkx(G).timestamps.tolist() == [MISSING_TIMESTAMP, 1_700_000_000]
+    graph = TransferGraph(['0xa', '0xb'], [0, 1], [1, 0], timestamps=np.array([np.nan, 1.7e9]))
+    assert graph.timestamps.tolist() == [MISSING_TIMESTAMP, 1_700_000_000]
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_multi_source_bfs_matches_networkx(seed):
+    rng = np.random.default_rng(seed)
+    n_nodes = int(rng.integers(1, 40))
+    graph = TransferGraph(['{:03d}'.format(node) for node in range(n_nodes)], rng.integers(0, n_nodes, 3 * n_nodes),
+                          rng.integers(0, n_nodes, 3 * n_nodes))
+    G = nx.DiGraph()
+    G.add_nodes_from(range(n_nodes))
+    G.add_edges_from(zip(graph.sources.tolist(), graph.targets.tolist()))
+    sources = rng.choice(n_nodes, size=min(n_nodes, int(rng.integers(1, 4))), replace=False)
+    max_hops = None if seed % 2 else int(rng.integers(0, 4))
+    expected = np.full(n_nodes, -1)
+    for node, distance in nx.multi_source_dijkstra_path_length(G, set(sources.tolist()), cutoff=max_hops).items():
+        expected[node] = distance
+    assert multi_source_bfs(graph.out_offsets, graph.out_neighbors, sources,
+                            max_hops=max_hops).tolist() == expected.tolist()
+    # Early exit: the targets still get their distance
+    targets = rng.choice(n_nodes, size=min(n_nodes, 3), replace=False)
+    distances = graph.multi_source_bfs(sources, max_hops=max_hops, targets=targets)
+    assert distances[targets].tolist() == expected[targets].tolist()
+    # The reverse adjacency gives the distances to the sources
+    expected_reverse = np.full(n_nodes, -1)
+    for node, distance in nx.multi_source_dijkstra_path_length(G.reverse(), set(sources.tolist()),
+                                                               cutoff=max_hops).items():
+        expected_reverse[node] = distance
+    assert graph.multi_source_bfs(sources, reverse=True, max_hops=max_hops).tolist() == expected_reverse.tolist()
+
+
+def brute_force_arrival(sources, targets, block_numbers, is_exchange, claimant, claim_block):
+    # Level by level search over the (node, block of the last transfer) states: the minimum hops and the
+    # earliest arrival block over all the time-respecting paths stopping at the first exchange
+    best_hops, best_arrival = -1, -1
+    level, seen, hops = {(claimant, claim_block)}, set(), 0
+    while level:
+        seen |= level
+        hops += 1
+        next_level = set()
+        for node, block in level:
+            for edge in np.flatnonzero((sources == node) & (block_numbers >= block) & (sources != targets)):
+                if is_exchange[targets[edge]]:
+                    best_hops = hops if best_hops < 0 else best_hops
+                    best_arrival = int(block_numbers[edge]) if best_arrival < 0 else min(
+                        best_arrival, int(block_numbers[edge]))
+                elif (targets[edge], block_numbers[edge]) not in seen:
+                    next_level.add((int(targets[edge]), int(block_numbers[edge])))
+        level = next_level
+    return best_hops, best_arrival
+
+
+# Small graphs, then graphs over the 1024 edges of the first chunk of the sweep with up to 3000 blocks
+@pytest.mark.parametrize('seed, min_edges, max_nodes, max_blocks',
+                         [(seed, 1, 25, 15) for seed in range(100)] + [(seed, 1500, 1000, 3000) for seed in range(6)])
+def test_earliest_arrival_matches_brute_force(seed, min_edges, max_nodes, max_blocks):
+    rng = np.random.default_rng(seed)
+    n_nodes = int(rng.integers(max(2, min_edges // 2), max_nodes))
+    n_edges = int(rng.integers(min_edges, 4 * n_nodes))
+    sources, targets = rng.integers(0, n_nodes, n_edges), rng.integers(0, n_nodes, n_edges)
+    block_numbers = rng.integers(0, int(rng.integers(1, max_blocks)), n_edges)
+    is_exchange = rng.random(n_nodes) < .2
+    claimants = np.flatnonzero(~is_exchange)
+    claim_blocks = rng.integers(0, max_blocks, len(claimants))
+    hops, arrivals = earliest_arrival(sources, targets, block_numbers, is_exchange, claimants, claim_blocks)
+    # The brute force is checked on a sample of the claimants of the large graphs
+    checked = range(len(claimants)) if len(claimants) <= 100 else rng.choice(len(claimants), 100, replace=False)
+    for index in checked:
+        claimant = claimants[index]
+        assert (hops[index], arrivals[index]) == brute_force_arrival(
+            sources, targets, block_numbers, is_exchange, claimant, claim_blocks[index])
+
+
+def test_temporal_hops():
+    transfers = pl.DataFrame({'from': ['0xa', '0xb', '0xa', '0xc'], 'to': ['0xb', '0xe', '0xc', '0xe'],
+                              'blockNumber': [5, 7, 2, 3]})
+    graph = TransferGraph.from_dataframe(transfers)
+    claims = graph.temporal_hops(['0xa', '0xc', '0xd'], [1, 4, 1], ['0xe']).sort('address')
+    # 0xa reaches the exchange in 2 hops by block 3 (through 0xc); 0xc only sends before its claim
+    assert claims['address'].to_list() == ['0xa', '0xc']
+    assert claims['hops'].to_list() == [2, None]
+    assert claims['arrival_block'].to_list() == [3, None]
+
+
+def test_temporal_hops_arrival_timestamp():
+    # The arrival timestamp skips the transfers of the arrival block without a timestamp
+    transfers = pl.DataFrame({'from': ['0xa', '0xb', '0xc', '0xc'], 'to': ['0xe', '0xa', '0xb', '0xd'],
+                              'blockNumber': [6, 6, 6, 6], 'timestamp': [None, 1_700_000_000, None, None]},
+                             schema_overrides={'timestamp': pl.Int64})
+    graph = TransferGraph.from_dataframe(transfers)
+    claims = graph.temporal_hops(['0xa'], [1], ['0xe'])
+    assert claims['arrival_block'].to_list() == [6]
+    assert claims['arrival_timestamp'].dt.epoch('s').to_list() == [1_700_000_000]
+    with pytest.raises(ValueError):
+        TransferGraph.from_dataframe(transfers.drop('blockNumber')).temporal_hops(['0xa'], [1], ['0xe'])